@@ -0,0 +1,72 @@
+"""Construction time of ``NanoAOD`` as a function of the number of branches
+
+Synthetic NanoAOD-like inputs are generated with a growing number of jagged collections
+(each with a counts branch ``n{name}`` and a fixed number of ``{name}_*`` branches), and the
+time to build NanoEvents is reported both for the first chunk (the build plan is compiled)
+and for later chunks (the cached build plan is replayed).
+
+Run with::
+
+    python docs/benchmarks/construction_scaling.py
+"""
+
+import timeit
+
+import awkward
+import numpy as np
+
+from awkward_zipper import NanoAOD
+
+N_EVENTS = 100
+FIELDS_PER_COLLECTION = 15
+
+
+def make_array(n_branches, n_events=N_EVENTS):
+    rng = np.random.default_rng(42)
+    n_collections = max(1, n_branches // (FIELDS_PER_COLLECTION + 1))
+    contents, fields = [], []
+    for event_id in ("run", "luminosityBlock", "event"):
+        contents.append(awkward.contents.NumpyArray(np.arange(n_events)))
+        fields.append(event_id)
+    for i in range(n_collections):
+        name = f"Collection{i}"
+        counts = rng.integers(0, 5, n_events)
+        offsets = np.zeros(n_events + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        contents.append(awkward.contents.NumpyArray(counts.astype(np.int32)))
+        fields.append("n" + name)
+        for j in range(FIELDS_PER_COLLECTION):
+            contents.append(
+                awkward.contents.ListOffsetArray(
+                    awkward.index.Index64(offsets),
+                    awkward.contents.NumpyArray(
+                        rng.random(offsets[-1], dtype=np.float32)
+                    ),
+                )
+            )
+            fields.append(f"{name}_field{j}")
+    return awkward.Array(
+        awkward.contents.RecordArray(contents, fields, length=n_events)
+    )
+
+
+def main():
+    print(f"{'branches':>10} {'first chunk [ms]':>18} {'later chunks [ms]':>18}")
+    for n_branches in (250, 500, 1000, 2000, 4000, 8000):
+        array = make_array(n_branches)
+        builder = NanoAOD()
+
+        def first_chunk(array=array, builder=builder):
+            NanoAOD._build_plans.clear()
+            builder(array)
+
+        def later_chunk(array=array, builder=builder):
+            builder(array)
+
+        first = min(timeit.repeat(first_chunk, number=1, repeat=5))
+        later = min(timeit.repeat(later_chunk, number=1, repeat=5))
+        print(f"{len(array.fields):>10} {1e3 * first:>18.2f} {1e3 * later:>18.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Build time of NanoEvents from eager (fully materialized) inputs
+
+The branches of ``tests/samples/nano_dy.root`` are read into memory and repeated to a growing
+number of events. NanoEvents are built from them with the eager builder, which assembles the
+layout right away from the Numpy buffers (``NanoAOD.__call__`` on eager inputs), and with the
+Form builder, which wraps every buffer in a generator and creates the layout with
+``awkward.from_buffers`` (the path that virtual inputs take).
+
+Run with::
+
+    python docs/benchmarks/eager_build.py
+"""
+
+import pathlib
+import timeit
+import warnings
+
+import awkward
+import uproot
+
+from awkward_zipper import NanoAOD
+from awkward_zipper.awkward_util import _ArraySource
+
+FILE_NAME = pathlib.Path(__file__).parents[2] / "tests" / "samples" / "nano_dy.root"
+
+
+def best_time(function, number=5):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number
+
+
+def main():
+    warnings.simplefilter("ignore", RuntimeWarning)
+    array = uproot.open(FILE_NAME)["Events"].arrays(ak_add_doc=True)
+    restructure = NanoAOD()
+    # compile the build plan and the kernels first
+    restructure(array)
+
+    print(f"{'events':>8}{'eager [ms]':>14}{'form [ms]':>14}{'ratio':>8}")
+    for repeat in (1, 10, 100):
+        chunk = awkward.concatenate([array] * repeat)
+        t_eager = best_time(lambda chunk=chunk: restructure(chunk))
+        t_form = best_time(lambda chunk=chunk: restructure._build(_ArraySource(chunk)))
+        print(
+            f"{len(chunk):>8}{1e3 * t_eager:>14.2f}{1e3 * t_form:>14.2f}"
+            f"{t_form / t_eager:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Run time of the GenPart genealogy kernels as a function of the particles per event
+
+Synthetic generator-level events are created with a growing number of particles per event,
+where every particle has a random mother among the particles before it (or none), and the
+time of every kernel on the whole chunk is reported, for the serial kernels and for the parallel
+kernels on all threads of numba (the ``parallel_threads`` argument of the kernels).
+
+Run with::
+
+    python docs/benchmarks/genealogy_kernels.py
+"""
+
+import timeit
+
+import awkward
+import numba
+import numpy as np
+
+from awkward_zipper.kernels import (
+    children,
+    counts2offsets,
+    distinct_children_deep,
+    distinct_parent,
+    genealogy,
+)
+
+N_EVENTS = 200
+
+
+def make_genparts(n_particles, n_events=N_EVENTS):
+    rng = np.random.default_rng(42)
+    counts = np.full(n_events, n_particles, dtype=np.int32)
+    offsets = counts2offsets(awkward.Array(counts))
+    # local mother index: -1 for the first particles, otherwise one of the particles before
+    local = np.tile(np.arange(n_particles), n_events)
+    mothers = (rng.random(len(local)) * local).astype(np.int64)
+    mothers[local < 2] = -1
+    global_mothers = np.where(
+        mothers >= 0, mothers + np.repeat(offsets[:-1], counts), -1
+    )
+    pdg = rng.choice(np.array([1, 2, 21, 22, 11, -11], dtype=np.int32), len(local))
+    return (
+        awkward.Array(counts),
+        awkward.unflatten(global_mothers, counts),
+        awkward.unflatten(pdg, counts),
+    )
+
+
+KERNELS = {
+    "children": lambda counts, mothers, pdg, **options: children(
+        counts, mothers, **options
+    ),
+    "distinct_children_deep": distinct_children_deep,
+    "distinct_parent": lambda counts, mothers, pdg, **options: distinct_parent(
+        mothers, pdg, **options
+    ),
+    # all of the above (and the children of the distinct parents), sharing the children
+    "genealogy": genealogy,
+}
+
+
+def main():
+    for n_threads in (None, numba.config.NUMBA_NUM_THREADS):
+        print("serial" if n_threads is None else f"parallel ({n_threads} threads)")
+        run(n_threads)
+
+
+def run(n_threads):
+    print(f"{'particles':>10}" + "".join(f"{name + ' [ms]':>30}" for name in KERNELS))
+    for n_particles in (50, 100, 200, 500, 1000):
+        inputs = make_genparts(n_particles)
+        times = [
+            min(
+                timeit.repeat(
+                    lambda kernel=kernel, inputs=inputs: kernel(
+                        *inputs, parallel_threads=n_threads
+                    ),
+                    number=1,
+                    repeat=5,
+                )
+            )
+            for kernel in KERNELS.values()
+        ]
+        print(f"{n_particles:>10}" + "".join(f"{1e3 * t:>30.2f}" for t in times))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Per-call overhead of the numba kernels for awkward arrays and for raw Numpy buffers
+
+The genealogy kernels are called on small synthetic chunks, once with their inputs wrapped
+as ``awkward.Array`` (which numba has to box and unbox as awkward array views) and once with
+the contiguous Numpy buffers that the kernels are passed now. The difference is the overhead
+that every kernel call paid when the inputs were wrapped.
+
+Run with::
+
+    python docs/benchmarks/kernel_call_overhead.py
+"""
+
+import timeit
+
+import awkward
+import numpy as np
+from genealogy_kernels import make_genparts
+
+from awkward_zipper.kernels import (
+    _children_kernel,
+    _distinct_children_deep_kernel,
+    _distinct_parent_kernel,
+    counts2offsets,
+)
+
+# the index dtype of the outputs
+DTYPE = np.dtype(np.int64)
+
+KERNELS = {
+    "children": lambda offsets, parents, pdgs: _children_kernel(
+        offsets, parents, DTYPE
+    ),
+    "distinct_children_deep": lambda offsets, parents, pdgs: (
+        _distinct_children_deep_kernel(offsets, parents, pdgs, DTYPE)
+    ),
+    "distinct_parent": lambda offsets, parents, pdgs: _distinct_parent_kernel(
+        offsets, parents, pdgs, DTYPE
+    ),
+}
+
+
+def flat_buffers(n_events, n_particles=20):
+    counts, parents, pdgs = make_genparts(n_particles, n_events=n_events)
+    return (
+        counts2offsets(counts),
+        awkward.to_numpy(awkward.flatten(parents)),
+        awkward.to_numpy(awkward.flatten(pdgs)),
+    )
+
+
+def best_time(kernel, inputs, number=100):
+    return min(timeit.repeat(lambda: kernel(*inputs), number=number, repeat=5)) / number
+
+
+def main():
+    print(
+        f"{'events':>8}{'kernel':>26}{'awkward [us]':>16}{'numpy [us]':>16}{'ratio':>8}"
+    )
+    for n_events in (1, 10, 100, 1000):
+        buffers = flat_buffers(n_events)
+        wrapped = tuple(awkward.Array(buffer) for buffer in buffers)
+        contiguous = tuple(np.ascontiguousarray(buffer) for buffer in buffers)
+        for name, kernel in KERNELS.items():
+            # compile both signatures first
+            kernel(*wrapped)
+            kernel(*contiguous)
+            t_wrapped = best_time(kernel, wrapped)
+            t_numpy = best_time(kernel, contiguous)
+            print(
+                f"{n_events:>8}{name:>26}{1e6 * t_wrapped:>16.1f}"
+                f"{1e6 * t_numpy:>16.1f}{t_wrapped / t_numpy:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
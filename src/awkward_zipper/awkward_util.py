@@ -1,52 +1,590 @@
+import functools
+import threading
 from collections.abc import Mapping
 
 import awkward
-
-
-def _check_equal_lengths(
-    contents: list[awkward.contents.Content],
-) -> int | awkward._nplikes.shape.UnknownLength:
-    unknown_length = awkward._nplikes.shape.unknown_length
-    length = awkward._util.maybe_length_of(contents[0])
-    if length is unknown_length:
-        return length
-    for layout in contents:
-        _length = awkward._util.maybe_length_of(layout)
-        if _length is unknown_length:
-            continue
-        if awkward._util.maybe_length_of(layout) != length:
-            msg = "all arrays must have the same length"
-            raise ValueError(msg)
-    return length
-
-
-def _non_materializing_get_field(record, field):
-    assert isinstance(field, str)
-    if isinstance(record, Mapping):
-        return record[field]
-    if isinstance(record, awkward.Array):
-        record = record.layout
-    assert isinstance(record, awkward.contents.RecordArray)
-    index = record.field_to_index(field)
-    return awkward.Array(record._contents[index])
+import numpy as np
 
 
 def _maybe_raw_generator(buffer):
     if isinstance(buffer, awkward._nplikes.virtual.VirtualNDArray):
+        if buffer.is_materialized:
+            # the generator of a materialized VirtualNDArray is dropped, reuse its array instead
+            array = buffer.materialize()
+            return lambda: array
         if hasattr(buffer._generator, "__awkward_raw_generator__"):
             # essentially we're forgetting all shape_generators here
             return buffer._generator.__awkward_raw_generator__
         return buffer._generator
+    if callable(buffer):
+        # already a generator (e.g. a buffer provider lookup)
+        return buffer
     # maybe assert that buffer is an array-like here?
     return lambda: buffer
 
 
-def _rewrap(array):
-    # here we rerun `ak.from_buffers` so that `ak.from_buffers` correctly recreates dynamically all VirtualNDArrays
-    # the current buffers may have 'wrong' generators on them. Not "wrong" in the sense that they would yield wrong
-    # buffers, but rather they would load too much.
-    form, length, buffers = awkward.to_buffers(array)
-    buffers = {key: _maybe_raw_generator(buffer) for key, buffer in buffers.items()}
-    return awkward.from_buffers(
-        form, length, buffers, behavior=array.behavior, attrs=array.attrs
+def _buffer_identity(buffer):
+    """Hashable identity of the data behind a buffer: buffers with the same identity hold the same data
+
+    An unmaterialized VirtualNDArray (or a generator) is identified by its raw generator, and an array
+    in memory by its memory location and layout, so that views of the same memory are identical.
+    """
+    if isinstance(buffer, awkward._nplikes.virtual.VirtualNDArray):
+        if not buffer.is_materialized:
+            return ("generator", id(_maybe_raw_generator(buffer)))
+        buffer = buffer.materialize()
+    if isinstance(buffer, np.ndarray):
+        return (
+            "array",
+            buffer.__array_interface__["data"][0],
+            buffer.shape,
+            buffer.strides,
+            buffer.dtype.str,
+        )
+    return ("generator", id(buffer))
+
+
+class _SharedGenerator:
+    """Generator shared by several buffers, which runs ``generator`` only once and hands out the same array"""
+
+    def __init__(self, generator):
+        self._generator = generator
+        self._lock = threading.Lock()
+        self._array = None
+
+    def __call__(self):
+        with self._lock:
+            if self._array is None:
+                self._array = self._generator()
+            return self._array
+
+
+def _materialized_buffers(layout):
+    """All buffers of a layout that are in memory (materialized VirtualNDArrays and concrete arrays)"""
+    if isinstance(layout, awkward.contents.NumpyArray):
+        buffers = [layout.data]
+    elif isinstance(layout, awkward.contents.ListOffsetArray):
+        # (its starts and stops are views of the offsets)
+        buffers = [layout.offsets.data]
+    else:
+        buffers = [
+            getattr(layout, attribute).data
+            for attribute in ("offsets", "starts", "stops", "index", "tags", "mask")
+            if hasattr(layout, attribute)
+        ]
+    for buffer in buffers:
+        if isinstance(buffer, awkward._nplikes.virtual.VirtualNDArray):
+            if buffer.is_materialized:
+                yield buffer.materialize()
+        else:
+            yield buffer
+    if hasattr(layout, "contents"):
+        for content in layout.contents:
+            yield from _materialized_buffers(content)
+    elif hasattr(layout, "content"):
+        yield from _materialized_buffers(layout.content)
+
+
+def _allocated(buffer):
+    """The array that holds the memory of a buffer, i.e. the base of a zero-stride (broadcast) view"""
+    while (
+        isinstance(buffer, np.ndarray)
+        and 0 in buffer.strides
+        and buffer.base is not None
+    ):
+        buffer = buffer.base
+    return buffer
+
+
+def _materialized_nbytes(*arrays):
+    """Memory held by the materialized buffers of ``arrays``, counting buffers shared between them once
+
+    Views are counted by the memory they are a view of (see ``_allocated``), so that e.g. the
+    zero-stride constant columns of ``full_like_from_counts`` are not counted by their length.
+    """
+    buffers = {
+        id(buffer): buffer
+        for array in arrays
+        for buffer in map(_allocated, _materialized_buffers(awkward.to_layout(array)))
+    }
+    return sum(buffer.nbytes for buffer in buffers.values())
+
+
+def _index_primitive(dtype):
+    return {"int32": "i32", "uint32": "u32", "int64": "i64"}[np.dtype(dtype).name]
+
+
+class _FormBuilder:
+    """Assembles the final Form of a layout builder together with its buffers
+
+    Every registered buffer gets a fresh form key and is stored as a raw generator
+    (see ``_maybe_raw_generator``), so that the final array is created by a single
+    ``awkward.from_buffers`` call. ``awkward.from_buffers`` then creates all
+    VirtualNDArrays with the correct shape generators, without building (and
+    serializing) an intermediate layout first.
+
+    The ``origin`` set at the time a buffer is registered (e.g. the name of the input branch it
+    is taken from) is recorded per form key in ``origins``.
+
+    A buffer that holds the same data as an already registered one (see ``_buffer_identity``), e.g. an
+    aliased branch, keeps its own form key but shares the generator of the first one, so that the data
+    is materialized only once. ``shared`` maps the buffer key of the first one to all buffer keys sharing it.
+    """
+
+    def __init__(self):
+        self.container = {}
+        self.origin = None
+        self.origins = {}
+        self.shared = {}
+        self._n_nodes = 0
+        # buffer identity -> (buffer key, buffer), the buffer is kept so that its identity stays unique
+        self._registered = {}
+
+    def _form_key(self):
+        form_key = f"node{self._n_nodes}"
+        self._n_nodes += 1
+        self.origins[form_key] = self.origin
+        return form_key
+
+    def _register(self, key, buffer):
+        identity = _buffer_identity(buffer)
+        if identity not in self._registered:
+            self._registered[identity] = (key, buffer)
+            self.container[key] = _maybe_raw_generator(buffer)
+            return
+        first_key, _ = self._registered[identity]
+        if first_key not in self.shared:
+            self.container[first_key] = _SharedGenerator(self.container[first_key])
+            self.shared[first_key] = [first_key]
+        self.container[key] = self.container[first_key]
+        self.shared[first_key].append(key)
+
+    def numpy(self, data, parameters=None, primitive=None):
+        """NumpyForm for a flat ``data`` buffer
+
+        ``primitive`` is only needed if ``data`` is a generator (and has no dtype).
+        """
+        if primitive is None:
+            primitive = awkward.types.numpytype.dtype_to_primitive(data.dtype)
+        form_key = self._form_key()
+        self._register(f"{form_key}-data", data)
+        return awkward.forms.NumpyForm(
+            primitive, parameters=parameters, form_key=form_key
+        )
+
+    def list_offset(self, offsets, content, parameters=None, index=None):
+        """ListOffsetForm for an ``offsets`` buffer and an already registered ``content`` form
+
+        ``index`` is only needed if ``offsets`` is a generator (and has no dtype).
+        """
+        if isinstance(offsets, awkward.index.Index):
+            offsets = offsets.data
+        if index is None:
+            index = _index_primitive(offsets.dtype)
+        form_key = self._form_key()
+        self._register(f"{form_key}-offsets", offsets)
+        return awkward.forms.ListOffsetForm(
+            index, content, parameters=parameters, form_key=form_key
+        )
+
+    def regular(self, content, size, parameters=None):
+        """RegularForm of an already registered ``content`` form, in lists of ``size``"""
+        return awkward.forms.RegularForm(content, size, parameters=parameters)
+
+    def record(self, contents, fields, parameters=None):
+        """RecordForm of already registered ``contents``"""
+        return awkward.forms.RecordForm(
+            list(contents), list(fields), parameters=parameters
+        )
+
+    def layout(self, layout, parameters=None):
+        """Form of an existing layout, registering its buffers without copying them
+
+        ``parameters`` (if given) replace the parameters of the outermost node.
+        """
+        if parameters is None:
+            parameters = layout.parameters
+        if isinstance(layout, awkward.contents.NumpyArray):
+            return self.numpy(layout.data, parameters=parameters)
+        if isinstance(layout, awkward.contents.ListOffsetArray):
+            offsets = layout.offsets.data
+            if (
+                not isinstance(offsets, awkward._nplikes.virtual.VirtualNDArray)
+                and offsets[0] != 0
+            ):
+                # the content is shared with other lists (e.g. a sliced input array)
+                layout = layout.to_ListOffsetArray64(True)
+            return self.list_offset(
+                layout.offsets, self.layout(layout.content), parameters=parameters
+            )
+        if isinstance(layout, awkward.contents.RegularArray):
+            return self.regular(
+                self.layout(layout.content), layout.size, parameters=parameters
+            )
+        if isinstance(layout, awkward.contents.RecordArray):
+            return self.record(
+                [self.layout(content) for content in layout.contents],
+                layout.fields,
+                parameters=parameters,
+            )
+        msg = f"unsupported layout node {type(layout).__name__}"
+        raise TypeError(msg)
+
+    def form(self, form, buffer, parameters=None):
+        """Form of an existing Form, registering its buffers under new form keys
+
+        ``buffer(form_key, attribute)`` returns the buffer (or its generator) of a node
+        of ``form``. ``parameters`` (if given) replace the parameters of the outermost node.
+        """
+        if parameters is None:
+            parameters = form.parameters
+        if isinstance(form, awkward.forms.NumpyForm) and form.inner_shape == ():
+            return self.numpy(
+                buffer(form.form_key, "data"),
+                parameters=parameters,
+                primitive=form.primitive,
+            )
+        if isinstance(form, awkward.forms.ListOffsetForm):
+            return self.list_offset(
+                buffer(form.form_key, "offsets"),
+                self.form(form.content, buffer),
+                parameters=parameters,
+                index=form.offsets,
+            )
+        if isinstance(form, awkward.forms.RegularForm):
+            return self.regular(
+                self.form(form.content, buffer), form.size, parameters=parameters
+            )
+        if isinstance(form, awkward.forms.RecordForm):
+            return self.record(
+                [self.form(content, buffer) for content in form.contents],
+                form.fields,
+                parameters=parameters,
+            )
+        msg = f"unsupported form node {type(form).__name__}"
+        raise TypeError(msg)
+
+    def to_array(self, form, length, **kwargs):
+        """Create the final array from ``form`` and all registered buffers"""
+        return awkward.from_buffers(form, length, self.container, **kwargs)
+
+
+def _zero_based(layout):
+    """A branch whose offsets (if it is jagged) start at 0 and span all of its content
+
+    The branches of a sliced array share their contents with the lists outside of the slice,
+    while the kernels and the collections work on whole contents. Offsets in memory are rebased
+    right away, virtual offsets (and contents) when they are materialized.
+    """
+    if not isinstance(layout, awkward.contents.ListOffsetArray):
+        return layout
+    offsets = layout.offsets.data
+    if (
+        isinstance(offsets, awkward._nplikes.virtual.VirtualNDArray)
+        and not offsets.is_materialized
+    ):
+        return _rebased_virtual(layout)
+    if offsets[0] == 0 and offsets[-1] == layout.content.length:
+        return layout
+    return layout.to_ListOffsetArray64(True)
+
+
+def _rebased_virtual(layout):
+    """A virtual jagged branch with offsets that start at 0 and a content that they span
+
+    Both are only computed when they are materialized. The content of a branch of a sliced virtual
+    array is the part of the whole content within the offsets of the slice, so its length is only
+    known with the offsets (which an uproot branch reads together with its content anyway).
+    """
+    content = layout.content
+    if not isinstance(content, awkward.contents.NumpyArray) or not isinstance(
+        content.data, awkward._nplikes.virtual.VirtualNDArray
+    ):
+        return layout
+    offsets, data = layout.offsets.data, content.data
+
+    def _offsets():
+        array = offsets.materialize()
+        return array - array[0] if array[0] != 0 else array
+
+    def _content():
+        bounds = offsets.materialize()[[0, -1]]
+        array = data.materialize()
+        if bounds[0] == 0 and bounds[1] == len(array):
+            return array
+        return array[bounds[0] : bounds[1]]
+
+    def _content_shape():
+        start, stop = offsets.materialize()[[0, -1]]
+        return (int(stop - start), *data.shape[1:])
+
+    virtual = awkward._nplikes.virtual.VirtualNDArray
+    return layout.copy(
+        offsets=awkward.index.Index(
+            virtual(
+                offsets._nplike,
+                shape=offsets._shape,
+                dtype=offsets.dtype,
+                generator=_offsets,
+                buffer_key=offsets.buffer_key,
+            )
+        ),
+        content=content.copy(
+            data=virtual(
+                data._nplike,
+                shape=(awkward._nplikes.shape.unknown_length, *data._shape[1:]),
+                dtype=data.dtype,
+                generator=_content,
+                shape_generator=_content_shape,
+                buffer_key=data.buffer_key,
+            )
+        ),
     )
+
+
+def _in_memory(buffer):
+    """A buffer in memory (a materialized VirtualNDArray or an array) as the array itself"""
+    if isinstance(buffer, awkward._nplikes.virtual.VirtualNDArray):
+        return buffer.materialize()
+    return buffer
+
+
+class _EagerBuilder:
+    """Assembles the final layout of a layout builder directly from buffers in memory
+
+    It has the interface of ``_FormBuilder``, but every node is created right away from the
+    (Numpy) buffers, without generators, VirtualNDArrays or an ``awkward.from_buffers`` call.
+    It is used if all input branches are materialized (eager), e.g. ``TTree.arrays`` without
+    ``virtual=True``, and all buffers (including the outputs of the kernels) are in memory.
+    """
+
+    def __init__(self):
+        # set by the callers as for a ``_FormBuilder``, but not recorded
+        self.origin = None
+        # buffers in memory are shared as they are
+        self.shared = {}
+
+    def numpy(self, data, parameters=None, primitive=None):
+        """NumpyArray of a flat ``data`` buffer"""
+        return awkward.contents.NumpyArray(_in_memory(data), parameters=parameters)
+
+    def list_offset(self, offsets, content, parameters=None, index=None):
+        """ListOffsetArray of an ``offsets`` buffer and a ``content`` node"""
+        if isinstance(offsets, awkward.index.Index):
+            offsets = offsets.data
+        offsets = awkward.index.Index(_in_memory(offsets))
+        if isinstance(content, awkward.contents.RecordArray) and not content.fields:
+            # a record without fields does not know its length
+            content = awkward.contents.RecordArray(
+                [], [], length=int(offsets[-1]), parameters=content.parameters
+            )
+        return awkward.contents.ListOffsetArray(offsets, content, parameters=parameters)
+
+    def regular(self, content, size, parameters=None):
+        """RegularArray of a ``content`` node, in lists of ``size``"""
+        return awkward.contents.RegularArray(content, size, parameters=parameters)
+
+    def record(self, contents, fields, parameters=None):
+        """RecordArray of ``contents`` nodes"""
+        return awkward.contents.RecordArray(
+            list(contents),
+            list(fields),
+            # (the length of a record without fields is set by ``list_offset``)
+            length=None if fields else 0,
+            parameters=parameters,
+        )
+
+    def layout(self, layout, parameters=None):
+        """An existing layout with its buffers as they are
+
+        ``parameters`` (if given) replace the parameters of the outermost node.
+        """
+        if parameters is None:
+            parameters = layout.parameters
+        if isinstance(layout, awkward.contents.NumpyArray):
+            return self.numpy(layout.data, parameters=parameters)
+        if isinstance(layout, awkward.contents.ListOffsetArray):
+            return self.list_offset(
+                layout.offsets, self.layout(layout.content), parameters=parameters
+            )
+        if isinstance(layout, awkward.contents.RegularArray):
+            return self.regular(
+                self.layout(layout.content), layout.size, parameters=parameters
+            )
+        if isinstance(layout, awkward.contents.RecordArray):
+            return self.record(
+                [self.layout(content) for content in layout.contents],
+                layout.fields,
+                parameters=parameters,
+            )
+        msg = f"unsupported layout node {type(layout).__name__}"
+        raise TypeError(msg)
+
+    def to_array(self, layout, length, **kwargs):
+        """Create the final array from the assembled ``layout``"""
+        assert layout.length == length
+        return awkward.Array(layout, **kwargs)
+
+
+class _ArraySource:
+    """Input branches of a layout builder, taken from an ``awkward.Array`` of flat branches"""
+
+    def __init__(self, array):
+        layout = awkward.to_layout(array)
+        assert isinstance(layout, awkward.contents.RecordArray)
+        self.fields = layout.fields
+        self.length = layout.length
+        self.parameters = layout.parameters
+        # layouts of the branches by name (a RecordArray field lookup is a linear search)
+        self._layouts = dict(zip(layout.fields, layout._contents, strict=True))
+        # zero-based layouts of the branches, created on first use
+        self._branches = {}
+
+    def _branch(self, field):
+        branch = self._branches.get(field)
+        if branch is None:
+            branch = self._branches[field] = _zero_based(self._layouts[field])
+        return branch
+
+    def form(self, field):
+        """Form of a branch"""
+        return self._branch(field).form
+
+    def array(self, field):
+        """A branch as ``awkward.Array`` (without materializing it)"""
+        return awkward.Array(self._branch(field))
+
+    def offsets(self, field):
+        """Offsets buffer of a jagged branch"""
+        return self._branch(field).offsets
+
+    def register(self, builder, field, content=False, parameters=None):
+        """Register a branch (or only the content of a jagged branch) in a ``_FormBuilder``
+
+        The parameters of the branch are kept on the registered node, unless ``parameters`` is given.
+        """
+        layout = self._branch(field)
+        if parameters is None:
+            parameters = layout.parameters
+        if content:
+            layout = layout.content
+        return builder.layout(layout, parameters=parameters)
+
+
+class _FormSource:
+    """Input branches of a layout builder, described by a Form and fetched lazily by buffer key
+
+    ``buffer_provider`` is either a mapping from buffer keys (``"{form_key}-{attribute}"``, as in
+    ``awkward.from_buffers``) to arrays or generators, or a callable that takes a buffer key and
+    returns the array. Buffers are only requested from the provider when they are materialized.
+    """
+
+    def __init__(self, form, length, buffer_provider):
+        if isinstance(form, str):
+            form = awkward.forms.from_json(form)
+        elif isinstance(form, dict):
+            form = awkward.forms.from_dict(form)
+        assert isinstance(form, awkward.forms.RecordForm)
+        for field, content in zip(form.fields, form.contents, strict=True):
+            try:
+                _buffer_keys(content)
+            except TypeError as err:
+                msg = (
+                    f"{err} in branch {field!r}: only the flat, non-option forms "
+                    "produced by uproot are supported"
+                )
+                raise TypeError(msg) from None
+        self.fields = form.fields
+        self.length = length
+        self.parameters = form.parameters
+        self._forms = dict(zip(form.fields, form.contents, strict=True))
+        self._buffer_provider = buffer_provider
+        # branches that were already requested as arrays, so that all consumers share them
+        self._arrays = {}
+        # one generator per buffer key, so that every use of a buffer has the same identity
+        self._generators = {}
+
+    def _buffer(self, form_key, attribute):
+        key = f"{form_key}-{attribute}"
+        if isinstance(self._buffer_provider, Mapping):
+            return self._buffer_provider[key]
+        if form_key is None:
+            # (a Form without form keys is only used for its structure, e.g. in a dry run)
+            return functools.partial(self._buffer_provider, key)
+        return self._generators.setdefault(
+            key, functools.partial(self._buffer_provider, key)
+        )
+
+    def form(self, field):
+        """Form of a branch"""
+        return self._forms[field]
+
+    def array(self, field):
+        """A branch as ``awkward.Array``, created lazily from its buffers"""
+        if field not in self._arrays:
+            form = self._forms[field]
+            array = awkward.from_buffers(
+                form,
+                self.length,
+                {
+                    f"{form_key}-{attribute}": self._buffer(form_key, attribute)
+                    for form_key, attribute in _buffer_keys(form)
+                },
+            )
+            # setdefault: if two threads race here, both end up with the first stored array
+            return self._arrays.setdefault(field, array)
+        return self._arrays[field]
+
+    def offsets(self, field):
+        """Offsets buffer (generator) of a jagged branch"""
+        return self._buffer(self._forms[field].form_key, "offsets")
+
+    def register(self, builder, field, content=False, parameters=None):
+        """Register a branch (or only the content of a jagged branch) in a ``_FormBuilder``
+
+        The parameters of the branch are kept on the registered node, unless ``parameters`` is given.
+        """
+        form = self._forms[field]
+        if parameters is None:
+            parameters = form.parameters
+        if content:
+            form = form.content
+        return builder.form(form, self._buffer, parameters=parameters)
+
+
+def _buffer_keys(form):
+    """(form_key, attribute) of all buffers of a Form"""
+    if isinstance(form, awkward.forms.NumpyForm):
+        return [(form.form_key, "data")]
+    if isinstance(form, awkward.forms.ListOffsetForm):
+        return [(form.form_key, "offsets"), *_buffer_keys(form.content)]
+    if isinstance(form, awkward.forms.RegularForm):
+        return _buffer_keys(form.content)
+    if isinstance(form, awkward.forms.RecordForm):
+        return [key for content in form.contents for key in _buffer_keys(content)]
+    msg = f"unsupported form node {type(form).__name__}"
+    raise TypeError(msg)
+
+
+def _buffer_paths(form, path=""):
+    """(buffer key, path of the node and its attribute) of all buffers of a Form
+
+    The path of a node joins the fields of the records above it with dots, e.g. ``"Jet.pt-data"``.
+    """
+    if isinstance(form, awkward.forms.NumpyForm):
+        return [(f"{form.form_key}-data", f"{path}-data")]
+    if isinstance(form, awkward.forms.ListOffsetForm):
+        return [
+            (f"{form.form_key}-offsets", f"{path}-offsets"),
+            *_buffer_paths(form.content, path),
+        ]
+    if isinstance(form, awkward.forms.RegularForm):
+        return _buffer_paths(form.content, path)
+    if isinstance(form, awkward.forms.RecordForm):
+        return [
+            item
+            for field, content in zip(form.fields, form.contents, strict=True)
+            for item in _buffer_paths(content, f"{path}.{field}" if path else field)
+        ]
+    msg = f"unsupported form node {type(form).__name__}"
+    raise TypeError(msg)
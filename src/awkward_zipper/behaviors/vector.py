@@ -60,7 +60,8 @@ from vector.backends.awkward import (
     [
         numba.float32(numba.float32, numba.float32, numba.float32, numba.float32),
         numba.float64(numba.float64, numba.float64, numba.float64, numba.float64),
-    ]
+    ],
+    cache=True,
 )
 def _mass2_kernel(t, x, y, z):
     return t * t - x * x - y * y - z * z
@@ -70,7 +71,8 @@ def _mass2_kernel(t, x, y, z):
     [
         numba.float32(numba.float32, numba.float32),
         numba.float64(numba.float64, numba.float64),
-    ]
+    ],
+    cache=True,
 )
 def delta_phi(a, b):
     """Compute difference in angle given two angles a and b
@@ -84,7 +86,8 @@ def delta_phi(a, b):
     [
         numba.float32(numba.float32, numba.float32, numba.float32, numba.float32),
         numba.float64(numba.float64, numba.float64, numba.float64, numba.float64),
-    ]
+    ],
+    cache=True,
 )
 def delta_r(eta1, phi1, eta2, phi2):
     r"""Distance in (eta,phi) plane given two pairs of (eta,phi)
@@ -1,4 +1,5 @@
 import functools
+import typing as tp
 
 import awkward
 import numba
@@ -16,19 +17,85 @@ def ensure_array(arraylike):
     return np.asarray(arraylike)
 
 
+def _buffer_length(buffer):
+    """Length of a flat buffer: an int if it is known, otherwise a callable that finds it
+    (with the shape generator of a VirtualNDArray, i.e. without materializing it if possible)
+    """
+    if isinstance(buffer, awkward._nplikes.virtual.VirtualNDArray):
+        if buffer._shape_is_known:
+            return buffer._shape[0]
+        return lambda: buffer.shape[0]
+    return len(buffer)
+
+
+def _materialized(buffer):
+    """A flat buffer (VirtualNDArray, Index or array-like) as Numpy array"""
+    if isinstance(buffer, awkward._nplikes.virtual.VirtualNDArray):
+        return buffer.materialize()
+    return ensure_array(buffer)
+
+
+def _kernel_input(array):
+    """A (materialized) kernel input as contiguous Numpy array, which numba takes without any boxing"""
+    if isinstance(array, int | np.dtype | None):
+        return array
+    return np.ascontiguousarray(_materialized(array))
+
+
+def _derived_length(length, transform):
+    """``transform`` applied to a length from ``_buffer_length`` (keeping it lazy, if it is)"""
+    if callable(length):
+        return lambda: transform(length())
+    return transform(length)
+
+
+def _virtual_shape(length):
+    """``shape`` and ``shape_generator`` of a flat VirtualNDArray of a given (int, callable or None) length"""
+    if length is None:
+        return (awkward._nplikes.shape.unknown_length,), None
+    if callable(length):
+        return (awkward._nplikes.shape.unknown_length,), lambda: (length(),)
+    return (length,), None
+
+
+def _checked_index_dtype(dtype):
+    # the index arrays of the kernels are int16, int32 or int64; the global indices of a chunk
+    # have to fit into the dtype (see ``_check_index_range``)
+    dtype = np.dtype(dtype)
+    if dtype not in (np.int16, np.int32, np.int64):
+        msg = f"index dtype must be int16, int32 or int64, got {dtype}"
+        raise ValueError(msg)
+    return dtype
+
+
+def _check_index_range(n_targets, dtype):
+    # global indices go up to n_targets - 1
+    if n_targets - 1 > np.iinfo(dtype).max:
+        msg = (
+            f"global indices of {n_targets} elements do not fit into {dtype}, "
+            "use smaller chunks or a wider index dtype (see NanoAOD.index_dtype)"
+        )
+        raise OverflowError(msg)
+
+
 # function: tp.Callable[[],]
 def dispatch_wrap(function):
     @functools.wraps(function)
-    def _wrapper(*input_arrays, data=None, dtype=np.int64):
+    def _wrapper(*input_arrays, data=None, dtype=np.int64, length=None):
         """
         Calls a function and passes it input_arrays as parameters. Returns a function result in eager case.
          In virtual case returns a result from a function wrapped in a Virtual Array.
         Args:
-            input_arrays: function parameters. Awkward arrays and integers are accepted.
-             This is a VirtualNDArray generator limitation.
+            input_arrays: function parameters. Flat buffers (VirtualNDArrays, Numpy arrays, awkward
+             indices or flat awkward arrays) and integers are accepted. This is a VirtualNDArray
+             generator limitation. Every buffer is materialized as a whole and passed to the function
+             as contiguous Numpy array, so only the buffers that the function consumes should be
+             passed (e.g. the content of a jagged array, without its offsets).
             data: additional parameter for VirtualNDArray creation
             function: function to return
             dtype: additional parameter for VirtualNDArray creation
+            length: length of the result, if it is known without calling the function (an int,
+             or a callable, e.g. from ``_buffer_length``). Used as shape (generator) of the VirtualNDArray.
 
         Returns: function(input_arrays) or
          awkward.VirtualNDArray(generator=lambda: function(input_arrays))
@@ -36,34 +103,103 @@ def dispatch_wrap(function):
         """
         # Virtual array
         if data is not None:
+            shape, shape_generator = _virtual_shape(length)
             return awkward._nplikes.virtual.VirtualNDArray(
-                nplike=data._nplike,
-                shape=(awkward._nplikes.shape.unknown_length,),
+                # ``data`` may already be materialized while other inputs are still virtual
+                nplike=getattr(data, "_nplike", None)
+                or awkward._nplikes.numpy.Numpy.instance(),
+                shape=shape,
                 dtype=dtype,
-                generator=lambda: function(
-                    *(
-                        (
-                            array
-                            if isinstance(array, int)
-                            else awkward.materialize(array)
-                        )
-                        for array in input_arrays
-                    )
-                ),
-                shape_generator=None,
+                generator=lambda: function(*map(_kernel_input, input_arrays)),
+                shape_generator=shape_generator,
             )
         # concrete array
-        return function(*input_arrays)
+        return function(*map(_kernel_input, input_arrays))
 
     return _wrapper
 
 
-def local2globalindex(index, counts):
+def accepts_offsets(function):
+    """Mark a function whose first input is a counts branch as accepting the already computed
+    offsets of it as ``offsets`` keyword argument
+
+    Layout builders pass the shared offsets of the counts branch (see ``OffsetsRegistry``) only to
+    marked functions, e.g. in ``NanoAOD.special_items``, so any other callable is called with its
+    inputs only.
+    """
+    function.accepts_offsets = True
+    return function
+
+
+def accepts_kernel_options(function):
+    """Mark a function as accepting the kernel options of a layout builder (``index_dtype`` and
+    ``parallel_threads``) as keyword arguments
+
+    Layout builders bind their options (e.g. ``NanoAOD.index_dtype``) to the kernels when the
+    build plan is compiled. In ``NanoAOD.special_items``, only marked functions are passed them.
+    """
+    function.accepts_kernel_options = True
+    return function
+
+
+def _shared_outputs(function, n_outputs):
+    """
+    Split a function returning ``n_outputs`` arrays into ``n_outputs`` dispatch-wrapped functions
+    (see ``dispatch_wrap``), which share a single call of ``function``. In the virtual case, the
+    function runs once, when the first of its outputs is materialized.
+    """
+    results = []
+
+    def _output(i):
+        def _function(*input_arrays):
+            if not results:
+                results.append(function(*input_arrays))
+            return results[0][i]
+
+        return _function
+
+    return [dispatch_wrap(_output(i)) for i in range(n_outputs)]
+
+
+@numba.njit(nogil=True, cache=True)
+def _local2globalindex_kernel(index_offsets, index_content, target_offsets, dtype):
+    # one pass over the flat local indices, written into a single output buffer:
+    # negative (missing) and out of bounds indices become -1
+    out = np.full(len(index_content), -1, dtype=dtype)
+    for record_index in range(len(index_offsets) - 1):
+        start = target_offsets[record_index]
+        stop = target_offsets[record_index + 1]
+        for i in range(index_offsets[record_index], index_offsets[record_index + 1]):
+            local = index_content[i]
+            if local >= 0 and start + local < stop:
+                out[i] = start + local
+    return out
+
+
+@dispatch_wrap
+def _local2globalindex(index_offsets, index_content, target_offsets, dtype):
+    # the kernel does not check bounds, so both have to be of the same number of events
+    if len(index_offsets) != len(target_offsets):
+        msg = (
+            f"index of {len(index_offsets) - 1} events does not match "
+            f"target counts of {len(target_offsets) - 1} events"
+        )
+        raise ValueError(msg)
+    _check_index_range(target_offsets[-1], dtype)
+    return _local2globalindex_kernel(
+        index_offsets, index_content, target_offsets, dtype
+    )
+
+
+@accepts_offsets
+def local2globalindex(index, counts, offsets=None, index_dtype=np.int64):
     """
     Convert a jagged local index to a global index
 
     This is the same as local2global(index, counts2offsets(counts))
-    where local2global and counts2offsets are as in coffea.nanoevents.transforms
+    where local2global and counts2offsets are as in coffea.nanoevents.transforms.
+    Already computed ``offsets`` of the target ``counts`` (see ``OffsetsRegistry``) can be passed
+    to avoid converting the counts again.
 
     Example usage:
     Index array
@@ -73,21 +209,9 @@ def local2globalindex(index, counts):
     Output array will be:
     [[], [9], [], [21, 22]]
     (here 21=8+7+4+2)
+    The global index is of ``index_dtype`` (an ``OverflowError`` is raised if it does not fit).
     """
-
-    @dispatch_wrap
-    def _local2globalindex(index, counts):
-        offsets = counts2offsets(counts)
-        # make sure that offsets is always a Numpy array
-        offsets = ensure_array(offsets)
-        index = index.mask[index >= 0] + offsets[:-1]
-        index = index.mask[index < offsets[1:]]  # guard against out of bounds
-        # workaround ValueError: can not (unsafe) zip ListOffsetArrays with non-NumpyArray contents
-        # index.type is N * var * int32?
-        index = awkward.fill_none(index, -1)
-        output = awkward.flatten(index)
-        # make sure that output is always Numpy array
-        return ensure_array(output)
+    index_dtype = _checked_index_dtype(index_dtype)
 
     # Check if VirtualNDArray
     index_data = None
@@ -97,7 +221,18 @@ def local2globalindex(index, counts):
     # resulting global index will have the same offsets as local index
     index_offsets = index.layout.offsets
 
-    index_content = _local2globalindex(index, counts, data=index_data)
+    if offsets is None:
+        offsets = counts2offsets(counts)
+    index_content = _local2globalindex(
+        index_offsets.data,
+        index.layout.content.data,
+        offsets,
+        index_dtype,
+        data=index_data,
+        dtype=index_dtype,
+        # one global index per local index
+        length=_buffer_length(index.layout.content.data),
+    )
     # index_content shape would be index_data.shape
     index_content = awkward.contents.numpyarray.NumpyArray(index_content)
     # create new parameters for the final array
@@ -115,7 +250,7 @@ def local2globalindex(index, counts):
 def nestedindex(indices):
     """
     Concatenate a list of indices along a new axis
-    Outputs a jagged array with same outer shape as index arrays
+    Outputs a jagged array with same outer shape as index arrays, of regular lists (one entry per index)
 
     Example usage:
     First index array
@@ -130,25 +265,20 @@ def nestedindex(indices):
     """
 
     @dispatch_wrap
-    def _nestedindex_content(*indices):
+    def _nestedindex_content(*flat_indices):
         # return awkward.concatenate([idx[:, None] for idx in indexers], axis=1)
-        flat_indices = []
-        for idx in indices:
-            # flatten the index
-            flat_indices.append(awkward.Array(idx.layout.content))
-
         n = len(flat_indices)
-        out = np.empty(n * len(flat_indices[0]), dtype="int64")
+        # the (global) indices keep their dtype
+        out = np.empty(
+            n * len(flat_indices[0]),
+            dtype=np.result_type(*(idx.dtype for idx in flat_indices)),
+        )
         for i, idx in enumerate(flat_indices):
             #  index arrays should all be same shape flat arrays
             out[i::n] = idx
 
         return out
 
-    @dispatch_wrap
-    def _get_nested_index_offsets(nested_index_content, n_indices):
-        return np.arange(0, len(nested_index_content) + 1, n_indices, dtype=np.int64)
-
     def _combine_parameters(indices):
         parameters = {}
         for idx in indices:
@@ -175,18 +305,19 @@ def nestedindex(indices):
 
     # store offsets to later reapply them to the arrays
     offsets_stored = indices[0].layout.offsets
+    # n_indices entries per element of the (equally long) index contents
+    index_length = _buffer_length(indices[0].layout.content.data)
+    # the kernels only consume the flat contents of the (jagged) indices
+    flat_indices = [index.layout.content.data for index in indices]
     nested_index_content = _nestedindex_content(
-        *indices, data=index_data, dtype=np.int64
+        *flat_indices,
+        data=index_data,
+        dtype=np.result_type(*(index.layout.content.dtype for index in indices)),
+        length=_derived_length(index_length, lambda n: len(indices) * n),
     )
-    nested_index_content = awkward.contents.NumpyArray(nested_index_content)
-    nested_index_offsets = _get_nested_index_offsets(
-        nested_index_content, len(indices), data=index_data, dtype=np.int64
-    )
-
-    # combine offsets and content
-    nested_index = awkward.contents.ListOffsetArray(
-        awkward.index.Index64(nested_index_offsets),
-        nested_index_content,
+    # every element has exactly one entry per index, so no offsets are needed
+    nested_index = awkward.contents.RegularArray(
+        awkward.contents.NumpyArray(nested_index_content), len(indices)
     )
     # combine the parameters
     parameters = _combine_parameters(indices)
@@ -200,9 +331,13 @@ def nestedindex(indices):
     )
 
 
-def counts2nestedindex(local_counts, target_offsets):
+@accepts_offsets
+def counts2nestedindex(
+    local_counts, target_offsets, offsets=None, index_dtype=np.int64
+):
     """Turn jagged local counts into doubly-jagged global index into a target
-    Outputs a jagged array with same axis-0 shape as counts axis-1
+    Outputs a jagged array with same axis-0 shape as counts axis-1.
+    Already computed ``offsets`` of the target counts can be passed to avoid converting them again.
 
     Example usage:
     Local counts
@@ -213,15 +348,18 @@ def counts2nestedindex(local_counts, target_offsets):
     Target output
     [[[0, 1, 2, 3], [4, 5, 6], [7, 8]],
      [[9, 10, 11, 12], [13, 14]]]
+    The nested index is of ``index_dtype`` (an ``OverflowError`` is raised if it does not fit).
     """
+    index_dtype = _checked_index_dtype(index_dtype)
 
     @dispatch_wrap
-    def _arange(array):
-        return np.arange(array[-1], dtype=np.int64)
+    def _arange(array, dtype):
+        _check_index_range(array[-1], dtype)
+        return np.arange(array[-1], dtype=dtype)
 
     @dispatch_wrap
     def _flatten(array):
-        return awkward.flatten(array)
+        return ensure_array(array)
 
     if not isinstance(
         local_counts.layout, awkward.contents.listoffsetarray.ListOffsetArray
@@ -231,7 +369,8 @@ def counts2nestedindex(local_counts, target_offsets):
         raise RuntimeError
 
     # count offsets the same way as with counts2offsets in coffea.nanoevents.transforms
-    offsets = counts2offsets(target_offsets)
+    if offsets is None:
+        offsets = counts2offsets(target_offsets)
 
     # store offsets to later reapply them to the arrays
     offsets_stored = local_counts.layout.offsets
@@ -244,9 +383,20 @@ def counts2nestedindex(local_counts, target_offsets):
         local_counts_data = local_counts.layout.content.data
         local_counts_data_dtype = local_counts_data.dtype
 
-    nested_index_content = _arange(offsets, data=local_counts_data)
+    nested_index_content = _arange(
+        offsets,
+        index_dtype,
+        data=local_counts_data,
+        dtype=index_dtype,
+        length=lambda: int(_materialized(offsets)[-1]),
+    )
+    # the counts of all lists, in the same layout as the content of ``local_counts``
+    # (only the content is materialized, not the offsets)
     flat_counts = _flatten(
-        local_counts, data=local_counts_data, dtype=local_counts_data_dtype
+        local_counts.layout.content.data,
+        data=local_counts_data,
+        dtype=local_counts_data_dtype,
+        length=None if local_counts_data is None else _buffer_length(local_counts_data),
     )
 
     nested_index_offsets = counts2offsets(flat_counts)
@@ -290,21 +440,61 @@ def counts2offsets(counts):
         virtual_array = None
 
     if virtual_array is not None:
+        shape, shape_generator = _virtual_shape(
+            _derived_length(_buffer_length(virtual_array), lambda n: n + 1)
+        )
         return awkward._nplikes.virtual.VirtualNDArray(
             nplike=virtual_array._nplike,
-            shape=(awkward._nplikes.shape.unknown_length,),
+            shape=shape,
             dtype=np.int64,
-            generator=lambda: _counts2offsets(virtual_array.materialize()),
-            shape_generator=None,
+            # memoized, so that every array created from this generator shares one buffer
+            generator=functools.cache(
+                lambda: _counts2offsets(virtual_array.materialize())
+            ),
+            shape_generator=shape_generator,
         )
-    # concrete array
-    return _counts2offsets(counts.layout.data)
+    # concrete array (an awkward.Array, or a flat buffer as e.g. in ``counts2nestedindex``)
+    if isinstance(counts, awkward.Array):
+        counts = counts.layout.data
+    return _counts2offsets(_materialized(counts))
+
+
+class OffsetsRegistry:
+    """Offsets of counts branches, shared by all consumers within one layout construction
+
+    Every counts branch is converted with ``counts2offsets`` only once, so that all kernels
+    (and the jagged collection itself) use, and materialize, the same offsets buffer.
 
+    Example usage::
 
-def full_like_from_counts(counts, fill_value):
+        registry = OffsetsRegistry(lambda name: events_array[name])
+        offsets = registry["nJet"]
+    """
+
+    def __init__(self, get_counts):
+        self._get_counts = get_counts
+        self._offsets = {}
+
+    def __getitem__(self, counts_branch):
+        if counts_branch not in self._offsets:
+            # setdefault: if two threads race here, both end up with the first stored offsets
+            return self._offsets.setdefault(
+                counts_branch, counts2offsets(self._get_counts(counts_branch))
+            )
+        return self._offsets[counts_branch]
+
+    def __contains__(self, counts_branch):
+        return counts_branch in self._offsets
+
+
+@accepts_offsets
+def full_like_from_counts(counts, fill_value, offsets=None):
     """Create a jagged array shaped like a collection with ``counts`` elements per
     event, with every element set to ``fill_value`` (as float32).
 
+    The content is a read-only, zero-stride view of a single ``fill_value``, so
+    it takes no memory regardless of the number of elements.
+
     This mirrors coffea's ``full_like_from_offsets`` transform, but works from the
     ``n{collection}`` counts branch instead of the ``o{collection}`` offsets branch.
     It is used to synthesize branches (e.g. ``Photon_mass``, ``Jet_charge``) that
@@ -312,8 +502,8 @@ def full_like_from_counts(counts, fill_value):
 
     Only the flat content of the returned array is ultimately consumed by the
     schema (the collection re-wraps it with its own offsets), but a valid
-    ``ListOffsetArray`` is returned so that ``awkward.to_buffers`` yields the
-    expected ``{"node0-offsets", "node1-data"}`` buffers.
+    ``ListOffsetArray`` is returned so that it can be used like any other branch.
+    Already computed ``offsets`` of the ``counts`` can be passed to avoid converting them again.
     """
 
     def _offsets_from_counts(counts_arr):
@@ -326,30 +516,35 @@ def full_like_from_counts(counts, fill_value):
     def _content_from_counts(counts_arr):
         counts_arr = ensure_array(counts_arr)
         n_elements = int(counts_arr.sum())
-        return np.full(n_elements, fill_value, dtype=np.float32)
+        # a read-only view with stride 0: no memory is allocated for the constant values
+        return np.broadcast_to(np.float32(fill_value), (n_elements,))
 
     if not counts.layout.is_all_materialized:
         virtual_array = counts.layout.data
         # the outer (per-event) length is known even when the data is virtual, so
-        # give the offsets a concrete shape: this keeps awkward.to_buffers from
-        # having to materialize the counts just to learn the list length
+        # give the offsets a concrete shape: this keeps awkward from having to
+        # materialize the counts just to learn the list length
         n_events = counts.layout.length
-        offsets = awkward._nplikes.virtual.VirtualNDArray(
-            nplike=virtual_array._nplike,
-            shape=(n_events + 1,),
-            dtype=np.int64,
-            generator=lambda: _offsets_from_counts(virtual_array.materialize()),
-            shape_generator=None,
-        )
+        if offsets is None:
+            offsets = awkward._nplikes.virtual.VirtualNDArray(
+                nplike=virtual_array._nplike,
+                shape=(n_events + 1,),
+                dtype=np.int64,
+                generator=lambda: _offsets_from_counts(virtual_array.materialize()),
+                shape_generator=None,
+            )
+        # the content is as long as the total count, which only needs the (shared) offsets
+        shape, shape_generator = _virtual_shape(lambda: int(_materialized(offsets)[-1]))
         content = awkward._nplikes.virtual.VirtualNDArray(
             nplike=virtual_array._nplike,
-            shape=(awkward._nplikes.shape.unknown_length,),
+            shape=shape,
             dtype=np.float32,
             generator=lambda: _content_from_counts(virtual_array.materialize()),
-            shape_generator=None,
+            shape_generator=shape_generator,
         )
     else:
-        offsets = _offsets_from_counts(counts)
+        if offsets is None:
+            offsets = _offsets_from_counts(counts)
         content = _content_from_counts(counts)
 
     return awkward.Array(
@@ -359,31 +554,164 @@ def full_like_from_counts(counts, fill_value):
     )
 
 
-@dispatch_wrap
-@numba.njit
-def _distinct_parent_kernel(allpart_parent, allpart_pdg):
-    out = np.empty(len(allpart_pdg), dtype=np.int64)
-    for i in range(len(allpart_pdg)):
-        parent = allpart_parent[i]
+def _check_parallel_threads(n_threads):
+    # the genealogy kernels run in parallel over events on ``n_threads`` threads, or serially if None
+    if n_threads is not None and not 1 <= n_threads <= numba.config.NUMBA_NUM_THREADS:
+        msg = f"parallel_threads must be between 1 and {numba.config.NUMBA_NUM_THREADS}, got {n_threads}"
+        raise ValueError(msg)
+
+
+def _threaded(serial_kernel, parallel_kernel):
+    """Kernel that dispatches to ``serial_kernel`` if ``n_threads`` is None, or else to ``parallel_kernel``"""
+
+    def _kernel(n_threads, *arrays):
+        if n_threads is None:
+            return serial_kernel(*arrays)
+        # the number of threads is a per (calling) thread setting of numba,
+        # which is restored for the other parallel code of the calling thread
+        previous = numba.get_num_threads()
+        numba.set_num_threads(n_threads)
+        try:
+            return parallel_kernel(*arrays)
+        finally:
+            numba.set_num_threads(previous)
+
+    return _kernel
+
+
+# errors of ``_resolve_distinct_parent``, which are raised outside of the parallel loops
+# (numba does not propagate exceptions out of them)
+_PARENT_BEYOND_LENGTH = 1
+_PARENT_CYCLE = 2
+
+
+@numba.njit(nogil=True, cache=True)
+def _raise_distinct_parent_error(error):
+    if error == _PARENT_BEYOND_LENGTH:
+        msg = "parent index beyond length of array!"
+        raise RuntimeError(msg)
+    if error == _PARENT_CYCLE:
+        msg = "parent indices with the same pdg id form a cycle!"
+        raise RuntimeError(msg)
+
+
+@numba.njit(nogil=True, cache=True, inline="always")
+def _resolve_distinct_parent(i, allpart_parent, allpart_pdg, out, chain, start, stop):
+    # the distinct parent of a particle is the distinct parent of its parent if both have the
+    # same pdg id, so it is resolved once per particle and reused by all particles further down
+    # a same-pdg chain. Only particles in [start, stop) are memoized in ``out`` (and ``chain``
+    # starting at ``start`` is used as scratch), so that events can be resolved in parallel.
+    # Returns 0, or the error (see ``_raise_distinct_parent_error``).
+    unresolved = -2
+    in_progress = -3
+    n_chain = 0
+    current = i
+    while True:
+        parent = allpart_parent[current]
         if parent < 0:
-            out[i] = -1
-            continue
-        thispdg = allpart_pdg[i]
-        while parent >= 0 and allpart_pdg[parent] == thispdg:
-            if parent >= len(allpart_pdg):
-                msg = "parent index beyond length of array!"
-                raise RuntimeError(msg)
-            parent = allpart_parent[parent]
-        out[i] = parent
+            result = -1
+            break
+        if parent >= len(allpart_pdg):
+            return _PARENT_BEYOND_LENGTH
+        if allpart_pdg[parent] != allpart_pdg[current]:
+            result = parent
+            break
+        if parent < start or parent >= stop:
+            # a parent outside of the event: walk the rest of the chain without memoizing it
+            result = -1
+            for _ in range(len(allpart_pdg)):
+                current = parent
+                parent = allpart_parent[current]
+                if parent < 0:
+                    break
+                if parent >= len(allpart_pdg):
+                    return _PARENT_BEYOND_LENGTH
+                if allpart_pdg[parent] != allpart_pdg[current]:
+                    result = parent
+                    break
+            else:
+                return _PARENT_CYCLE
+            current = i
+            break
+        if out[parent] == in_progress:
+            return _PARENT_CYCLE
+        if out[parent] != unresolved:
+            result = out[parent]
+            break
+        # same pdg id and not resolved yet: continue with the parent
+        out[current] = in_progress
+        chain[start + n_chain] = current
+        n_chain = n_chain + 1
+        current = parent
+    out[current] = result
+    for chain_index in range(start, start + n_chain):
+        out[chain[chain_index]] = result
+    return 0
+
+
+@numba.njit(nogil=True, cache=True)
+def _distinct_parent_kernel(offsets_in, allpart_parent, allpart_pdg, dtype):
+    # linear in the number of particles, see ``_resolve_distinct_parent``
+    out = np.full(len(allpart_pdg), -2, dtype=dtype)
+    # particles of the chain that is being resolved
+    chain = np.empty(len(allpart_pdg), dtype=np.int64)
+    for i in range(len(allpart_pdg)):
+        if out[i] == -2:
+            error = _resolve_distinct_parent(
+                i, allpart_parent, allpart_pdg, out, chain, 0, len(allpart_pdg)
+            )
+            if error != 0:
+                _raise_distinct_parent_error(error)
+    return out
+
+
+@numba.njit(nogil=True, parallel=True, cache=True)
+def _distinct_parent_kernel_parallel(offsets_in, allpart_parent, allpart_pdg, dtype):
+    out = np.full(len(allpart_pdg), -2, dtype=dtype)
+    chain = np.empty(len(allpart_pdg), dtype=np.int64)
+    errors = np.zeros(len(offsets_in) - 1, dtype=np.int8)
+    for record_index in numba.prange(len(offsets_in) - 1):
+        start_src, stop_src = offsets_in[record_index], offsets_in[record_index + 1]
+        for i in range(start_src, stop_src):
+            if out[i] == -2:
+                errors[record_index] = _resolve_distinct_parent(
+                    i, allpart_parent, allpart_pdg, out, chain, start_src, stop_src
+                )
+                if errors[record_index] != 0:
+                    break
+    for error in errors:
+        if error != 0:
+            _raise_distinct_parent_error(error)
+    # particles that are not in any event (e.g. the content of a sliced array)
+    for i in range(len(allpart_pdg)):
+        if out[i] == -2:
+            error = _resolve_distinct_parent(
+                i, allpart_parent, allpart_pdg, out, chain, 0, len(allpart_pdg)
+            )
+            if error != 0:
+                _raise_distinct_parent_error(error)
     return out
 
 
-def distinct_parent(parents, pdg):
+_distinct_parent = _threaded(_distinct_parent_kernel, _distinct_parent_kernel_parallel)
+
+
+def _checked_distinct_parent(offsets_in, allpart_parent, allpart_pdg, dtype, n_threads):
+    _check_index_range(len(allpart_parent), dtype)
+    return _distinct_parent(n_threads, offsets_in, allpart_parent, allpart_pdg, dtype)
+
+
+@accepts_kernel_options
+def distinct_parent(parents, pdg, index_dtype=np.int64, parallel_threads=None):
     """Compute first parent with distinct PDG id
 
     Signature: globalparents,globalpdgs,!distinctParent
-    Expects global indexes, flat arrays, which should be same length
+    Expects global indexes, flat arrays, which should be same length.
+    The indices are of ``index_dtype`` (an ``OverflowError`` is raised if they do not fit).
+    With ``parallel_threads``, the kernel runs in parallel over events on that many threads.
     """
+    index_dtype = _checked_index_dtype(index_dtype)
+    _check_parallel_threads(parallel_threads)
     if not isinstance(pdg.layout, awkward.contents.listoffsetarray.ListOffsetArray):
         raise RuntimeError
     if not isinstance(parents.layout, awkward.contents.listoffsetarray.ListOffsetArray):
@@ -396,11 +724,16 @@ def distinct_parent(parents, pdg):
 
     # store offsets to later reapply them
     result_offsets = parents.layout.offsets
-    # calculate the contents
-    result_content = _distinct_parent_kernel(
-        awkward.Array(parents.layout.content),
-        awkward.Array(pdg.layout.content),
+    # calculate the contents (the offsets split the work by event in the parallel case)
+    result_content = dispatch_wrap(_checked_distinct_parent)(
+        result_offsets.data,
+        parents.layout.content.data,
+        pdg.layout.content.data,
+        index_dtype,
+        parallel_threads,
         data=parents_data,
+        dtype=index_dtype,
+        length=_buffer_length(parents.layout.content.data),
     )
 
     return awkward.Array(
@@ -411,67 +744,76 @@ def distinct_parent(parents, pdg):
     )
 
 
-@dispatch_wrap
-@numba.njit
-def _children_kernel_content(offsets_in, parentidx):
-    content1_out = np.empty(len(parentidx), dtype=np.int64)
+def _children_csr(offsets_in, parentidx, include_self, dtype):
+    # counting sort of the (parent, child) pairs by parent: one pass counts the children
+    # of every particle, a second pass fills them in (in ascending order). Events are
+    # independent (``prange`` is a plain ``range`` in the serial kernel).
+    offsets_out = np.zeros(len(parentidx) + 1, dtype=np.int64)
+    for record_index in numba.prange(len(offsets_in) - 1):
+        start_src, stop_src = offsets_in[record_index], offsets_in[record_index + 1]
+        for child in range(start_src, stop_src):
+            parent = parentidx[child]
+            if start_src <= parent < child or (include_self and parent == child):
+                offsets_out[parent + 1] += 1
 
-    offset1 = 0
-    for record_index in range(len(offsets_in) - 1):
+    for index in range(len(parentidx)):
+        offsets_out[index + 1] += offsets_out[index]
+
+    content_out = np.empty(offsets_out[-1], dtype=dtype)
+    fill = offsets_out[:-1].copy()
+    for record_index in numba.prange(len(offsets_in) - 1):
         start_src, stop_src = offsets_in[record_index], offsets_in[record_index + 1]
+        for child in range(start_src, stop_src):
+            parent = parentidx[child]
+            if start_src <= parent < child or (include_self and parent == child):
+                content_out[fill[parent]] = child
+                fill[parent] += 1
 
-        for index in range(start_src, stop_src):
-            for possible_child in range(index, stop_src):
-                if parentidx[possible_child] == index:
-                    if offset1 >= len(content1_out):
-                        msg = "offset1 went out of bounds!"
-                        raise RuntimeError(msg)
-                    content1_out[offset1] = possible_child
-                    offset1 = offset1 + 1
+    return offsets_out, content_out
 
-    return content1_out[:offset1]
 
+_children_csr_serial = numba.njit(nogil=True, cache=True)(_children_csr)
+# not cached: the on-disk cache of a function does not tell its serial and parallel compilations apart
+_children_csr_parallel = numba.njit(nogil=True, parallel=True)(_children_csr)
 
-@dispatch_wrap
-@numba.njit
-def _children_kernel_offsets(offsets_in, parentidx, content1_out):
-    offsets1_out = np.empty(len(parentidx) + 1, dtype=np.int64)
-    # content1_out = np.empty(len(parentidx), dtype=np.int64)
-    offsets1_out[0] = 0
 
-    offset0 = 1
-    offset1 = 0
-    for record_index in range(len(offsets_in) - 1):
-        start_src, stop_src = offsets_in[record_index], offsets_in[record_index + 1]
+def _children_kernel(offsets_in, parentidx, dtype):
+    return _children_csr_serial(offsets_in, parentidx, True, dtype)
 
-        for index in range(start_src, stop_src):
-            for possible_child in range(index, stop_src):
-                if parentidx[possible_child] == index:
-                    if offset1 >= len(content1_out):
-                        msg = "offset1 went out of bounds!"
-                        raise RuntimeError(msg)
-                    # content1_out[offset1] = possible_child
-                    offset1 = offset1 + 1
-            if offset0 >= len(offsets1_out):
-                msg = "offset0 went out of bounds!"
-                raise RuntimeError(msg)
-            offsets1_out[offset0] = offset1
-            offset0 = offset0 + 1
-
-    return offsets1_out
-
-
-def children(counts, globalparents):
+
+def _children_kernel_parallel(offsets_in, parentidx, dtype):
+    return _children_csr_parallel(offsets_in, parentidx, True, dtype)
+
+
+_children = _threaded(_children_kernel, _children_kernel_parallel)
+
+
+def _checked_children(offsets_in, parentidx, dtype, n_threads):
+    _check_index_range(len(parentidx), dtype)
+    return _children(n_threads, offsets_in, parentidx, dtype)
+
+
+@accepts_offsets
+@accepts_kernel_options
+def children(
+    counts, globalparents, offsets=None, index_dtype=np.int64, parallel_threads=None
+):
     """Compute children
 
     Signature: offsets,globalparents,!children
-    Output will be a jagged array with same outer shape as globalparents content
+    Output will be a jagged array with same outer shape as globalparents content.
+    Already computed ``offsets`` of the ``counts`` can be passed to avoid converting them again.
+    The indices are of ``index_dtype`` (an ``OverflowError`` is raised if they do not fit).
+    With ``parallel_threads``, the kernel runs in parallel over events on that many threads.
     """
+    index_dtype = _checked_index_dtype(index_dtype)
+    _check_parallel_threads(parallel_threads)
     if not isinstance(
         globalparents.layout, awkward.contents.listoffsetarray.ListOffsetArray
     ):
         raise RuntimeError
-    offsets = counts2offsets(counts)
+    if offsets is None:
+        offsets = counts2offsets(counts)
 
     # Check if VirtualNDArray
     globalparents_data = None
@@ -481,18 +823,24 @@ def children(counts, globalparents):
         globalparents_data = globalparents.layout.content.data
     # store offsets to later reapply them
     result_offsets = globalparents.layout.offsets
-    # Numba can't accept Virtual arrays directly, so wrap them with awkward
-    ccontent = _children_kernel_content(
-        awkward.Array(awkward.contents.NumpyArray(offsets)),
-        awkward.Array(globalparents.layout.content),
-        data=globalparents_data,
+    # Numba can't accept Virtual arrays directly, the buffers are materialized as Numpy arrays
+    # offsets and content come from a single O(n) pass of the kernel
+    offsets_kernel, content_kernel = _shared_outputs(_checked_children, 2)
+    kernel_inputs = (
+        offsets,
+        globalparents.layout.content.data,
+        index_dtype,
+        parallel_threads,
     )
-    ccontent = awkward.contents.NumpyArray(ccontent)
-    coffsets = _children_kernel_offsets(
-        awkward.Array(awkward.contents.NumpyArray(offsets)),
-        awkward.Array(globalparents.layout.content),
-        awkward.Array(ccontent),
+    coffsets = offsets_kernel(
+        *kernel_inputs,
         data=globalparents_data,
+        length=_derived_length(
+            _buffer_length(globalparents.layout.content.data), lambda n: n + 1
+        ),
+    )
+    ccontent = awkward.contents.NumpyArray(
+        content_kernel(*kernel_inputs, data=globalparents_data, dtype=index_dtype)
     )
 
     out = awkward.contents.ListOffsetArray(
@@ -509,172 +857,229 @@ def children(counts, globalparents):
     )
 
 
-@dispatch_wrap
-@numba.njit
-def _distinct_children_deep_kernel_content(offsets_in, global_parents, global_pdgs):
-    # offsets_out = np.empty(len(global_parents) + 1, dtype=np.int64)
-    content_out = np.empty(len(global_parents), dtype=np.int64)
-    # offsets_out[0] = 0
+@numba.njit(nogil=True, cache=True)
+def _sort_range(array, start, stop):
+    # sort array[start:stop] in place, with an insertion sort for the (usual) short ranges
+    if stop - start > 32:
+        array[start:stop].sort()
+        return
+    for index in range(start + 1, stop):
+        value = array[index]
+        position = index - 1
+        while position >= start and array[position] > value:
+            array[position + 1] = array[position]
+            position = position - 1
+        array[position + 1] = value
+
+
+@numba.njit(nogil=True, cache=True)
+def _deep_chain(
+    index,
+    child_offsets,
+    child_content,
+    global_pdgs,
+    chain,
+    chain_start,
+    content_out,
+    content_start,
+    fill,
+):
+    # number of distinct children of the chain starting at ``index``, which are written to
+    # ``content_out`` from ``content_start`` on if ``fill`` (otherwise they are only counted).
+    # ``chain`` from ``chain_start`` on is used as scratch for the particles of the chain.
+    this_pdg = global_pdgs[index]
+    offset = content_start
+
+    # walk the chain of children with the same pdg id (``chain`` is the queue),
+    # children with a different pdg id are added to the content
+    chain[chain_start] = index
+    chain_stop = chain_start + 1
+    position = chain_start
+    while position < chain_stop:
+        member = chain[position]
+        position = position + 1
+        for child_index in range(child_offsets[member], child_offsets[member + 1]):
+            child = child_content[child_index]
+            if global_pdgs[child] == this_pdg:
+                chain[chain_stop] = child
+                chain_stop = chain_stop + 1
+            else:
+                if fill:
+                    content_out[offset] = child
+                offset = offset + 1
+    if fill:
+        _sort_range(content_out, content_start, offset)
+        _sort_range(chain, chain_start + 1, chain_stop)
+
+    # add the particles of the chain (except the first) that have no children
+    for chain_index in range(chain_start + 1, chain_stop):
+        member = chain[chain_index]
+        if child_offsets[member] == child_offsets[member + 1]:
+            if fill:
+                content_out[offset] = member
+            offset = offset + 1
+    return offset - content_start
+
+
+@numba.njit(nogil=True, cache=True)
+def _check_parents(global_parents):
+    # checked before the (parallel) loops, since numba does not propagate exceptions out of them
+    for parent in global_parents:
+        if parent >= len(global_parents):
+            msg = "parent index beyond length of array!"
+            raise RuntimeError(msg)
+
+
+@numba.njit(nogil=True, cache=True)
+def _is_chain_head(index, global_parents, global_pdgs):
+    parent = global_parents[index]
+    # only perform the deep lookup when this particle is not already part of a decay chain
+    # otherwise, the same child indices would be repeated for every parent in the chain
+    return parent >= 0 and global_pdgs[index] != global_pdgs[parent]
+
+
+@numba.njit(nogil=True, cache=True)
+def _distinct_children_deep_csr_kernel(
+    offsets_in, global_parents, global_pdgs, child_offsets, child_content, dtype
+):
+    # ``child_offsets`` and ``child_content`` are the children of every particle as CSR, in
+    # ascending order (see ``_children_csr``). A particle that is its own parent is never the
+    # head or a member of a chain, so whether it is listed as its own child does not matter.
+    _check_parents(global_parents)
+
+    # every particle is part of at most one decay chain, so the content is at most as long as the input
+    offsets_out = np.empty(len(global_parents) + 1, dtype=np.int64)
+    offsets_out[0] = 0
+    content_out = np.empty(len(global_parents), dtype=dtype)
+    # particles of the current chain with the same pdg id, reused for all chains
+    chain = np.empty(len(global_parents), dtype=np.int64)
 
-    # offset0 = 1
     offset1 = 0
     for record_index in range(len(offsets_in) - 1):
         start_src, stop_src = offsets_in[record_index], offsets_in[record_index + 1]
+        for index in range(start_src, stop_src):
+            if _is_chain_head(index, global_parents, global_pdgs):
+                offset1 += _deep_chain(
+                    index,
+                    child_offsets,
+                    child_content,
+                    global_pdgs,
+                    chain,
+                    0,
+                    content_out,
+                    offset1,
+                    True,
+                )
+            offsets_out[index + 1] = offset1
+
+    return offsets_out, content_out[:offset1]
+
+
+@numba.njit(nogil=True, parallel=True, cache=True)
+def _distinct_children_deep_csr_kernel_parallel(
+    offsets_in, global_parents, global_pdgs, child_offsets, child_content, dtype
+):
+    _check_parents(global_parents)
+    # the chain of a particle stays in its event, so the scratch of every event is its own range
+    chain = np.empty(len(global_parents), dtype=np.int64)
 
+    # count the distinct children of every particle, then fill them in at the summed offsets
+    offsets_out = np.zeros(len(global_parents) + 1, dtype=np.int64)
+    for record_index in numba.prange(len(offsets_in) - 1):
+        start_src, stop_src = offsets_in[record_index], offsets_in[record_index + 1]
+        for index in range(start_src, stop_src):
+            if _is_chain_head(index, global_parents, global_pdgs):
+                offsets_out[index + 1] = _deep_chain(
+                    index,
+                    child_offsets,
+                    child_content,
+                    global_pdgs,
+                    chain,
+                    start_src,
+                    offsets_out,
+                    0,
+                    False,
+                )
+    for index in range(len(global_parents)):
+        offsets_out[index + 1] += offsets_out[index]
+
+    content_out = np.empty(offsets_out[-1], dtype=dtype)
+    for record_index in numba.prange(len(offsets_in) - 1):
+        start_src, stop_src = offsets_in[record_index], offsets_in[record_index + 1]
         for index in range(start_src, stop_src):
-            this_pdg = global_pdgs[index]
-
-            # only perform the deep lookup when this particle is not already part of a decay chain
-            # otherwise, the same child indices would be repeated for every parent in the chain
-            # which would require content_out to have a length that isa-priori unknown
-            if (
-                global_parents[index] >= 0
-                and this_pdg != global_pdgs[global_parents[index]]
-            ):
-                # keep an index of parents with same pdg id
-                parents = np.empty(stop_src - index, dtype=np.int64)
-                parents[0] = index
-                offset2 = 1
-
-                # keep an additional index with parents that have at least one child
-                parents_with_children = np.empty(stop_src - index, dtype=np.int64)
-                offset3 = 0
-
-                for possible_child in range(index, stop_src):
-                    possible_parent = global_parents[possible_child]
-                    possibe_child_pdg = global_pdgs[possible_child]
-
-                    # compare with seen parents
-                    for parent_index in range(offset2):
-                        # check if we found a new child
-                        if parents[parent_index] == possible_parent:
-                            # first, remember that the parent has at least one child
-                            if offset3 >= len(parents_with_children):
-                                msg = "offset3 went out of bounds!"
-                                raise RuntimeError(msg)
-                            parents_with_children[offset3] = possible_parent
-                            offset3 = offset3 + 1
-
-                            # then, depending on the pdg id, add to parents or content
-                            if possibe_child_pdg == this_pdg:
-                                # has the same pdg id, add to parents
-                                if offset2 >= len(parents):
-                                    msg = "offset2 went out of bounds!"
-                                    raise RuntimeError(msg)
-                                parents[offset2] = possible_child
-                                offset2 = offset2 + 1
-                            else:
-                                # has a different pdg id, add to content
-                                if offset1 >= len(content_out):
-                                    msg = "offset1 went out of bounds!"
-                                    raise RuntimeError(msg)
-                                content_out[offset1] = possible_child
-                                offset1 = offset1 + 1
-                            break
-
-                # add parents with same pdg id that have no children
-                for parent_index in range(1, offset2):
-                    possible_child = parents[parent_index]
-                    if possible_child not in parents_with_children[:offset3]:
-                        if offset1 >= len(content_out):
-                            msg = "offset1 went out of bounds! pt2"
-                            raise RuntimeError(msg)
-                        content_out[offset1] = possible_child
-
-                        offset1 = offset1 + 1
-
-    return content_out[:offset1]
+            if offsets_out[index + 1] > offsets_out[index]:
+                _deep_chain(
+                    index,
+                    child_offsets,
+                    child_content,
+                    global_pdgs,
+                    chain,
+                    start_src,
+                    content_out,
+                    offsets_out[index],
+                    True,
+                )
+
+    return offsets_out, content_out
+
+
+def _distinct_children_deep_kernel(offsets_in, global_parents, global_pdgs, dtype):
+    child_offsets, child_content = _children_csr_serial(
+        offsets_in, global_parents, False, dtype
+    )
+    return _distinct_children_deep_csr_kernel(
+        offsets_in, global_parents, global_pdgs, child_offsets, child_content, dtype
+    )
 
 
-@dispatch_wrap
-@numba.njit
-def _distinct_children_deep_kernel_offsets(
-    offsets_in, global_parents, global_pdgs, content_out
+def _distinct_children_deep_kernel_parallel(
+    offsets_in, global_parents, global_pdgs, dtype
 ):
-    offsets_out = np.empty(len(global_parents) + 1, dtype=np.int64)
-    offsets_out[0] = 0
+    child_offsets, child_content = _children_csr_parallel(
+        offsets_in, global_parents, False, dtype
+    )
+    return _distinct_children_deep_csr_kernel_parallel(
+        offsets_in, global_parents, global_pdgs, child_offsets, child_content, dtype
+    )
 
-    offset0 = 1
-    offset1 = 0
-    for record_index in range(len(offsets_in) - 1):
-        start_src, stop_src = offsets_in[record_index], offsets_in[record_index + 1]
 
-        for index in range(start_src, stop_src):
-            this_pdg = global_pdgs[index]
-
-            # only perform the deep lookup when this particle is not already part of a decay chain
-            # otherwise, the same child indices would be repeated for every parent in the chain
-            # which would require content_out to have a length that isa-priori unknown
-            if (
-                global_parents[index] >= 0
-                and this_pdg != global_pdgs[global_parents[index]]
-            ):
-                # keep an index of parents with same pdg id
-                parents = np.empty(stop_src - index, dtype=np.int64)
-                parents[0] = index
-                offset2 = 1
-
-                # keep an additional index with parents that have at least one child
-                parents_with_children = np.empty(stop_src - index, dtype=np.int64)
-                offset3 = 0
-
-                for possible_child in range(index, stop_src):
-                    possible_parent = global_parents[possible_child]
-                    possibe_child_pdg = global_pdgs[possible_child]
-
-                    # compare with seen parents
-                    for parent_index in range(offset2):
-                        # check if we found a new child
-                        if parents[parent_index] == possible_parent:
-                            # first, remember that the parent has at least one child
-                            if offset3 >= len(parents_with_children):
-                                msg = "offset3 went out of bounds!"
-                                raise RuntimeError(msg)
-                            parents_with_children[offset3] = possible_parent
-                            offset3 = offset3 + 1
-
-                            # then, depending on the pdg id, add to parents or content
-                            if possibe_child_pdg == this_pdg:
-                                # has the same pdg id, add to parents
-                                if offset2 >= len(parents):
-                                    msg = "offset2 went out of bounds!"
-                                    raise RuntimeError(msg)
-                                parents[offset2] = possible_child
-                                offset2 = offset2 + 1
-                            else:
-                                # has a different pdg id, add to content
-                                if offset1 >= len(content_out):
-                                    msg = "offset1 went out of bounds!"
-                                    raise RuntimeError(msg)
-                                offset1 = offset1 + 1
-                            break
-
-                # add parents with same pdg id that have no children
-                for parent_index in range(1, offset2):
-                    possible_child = parents[parent_index]
-                    if possible_child not in parents_with_children[:offset3]:
-                        if offset1 >= len(content_out):
-                            msg = "offset1 went out of bounds! pt2"
-                            raise RuntimeError(msg)
-
-                        offset1 = offset1 + 1
-
-            # finish this item by adding an offset
-            if offset0 >= len(offsets_out):
-                msg = "offset0 went out of bounds!"
-                raise RuntimeError(msg)
-            offsets_out[offset0] = offset1
-            offset0 = offset0 + 1
-
-    return offsets_out
-
-
-def distinct_children_deep(counts, global_parents, global_pdgs):
+_distinct_children_deep = _threaded(
+    _distinct_children_deep_kernel, _distinct_children_deep_kernel_parallel
+)
+_distinct_children_deep_csr = _threaded(
+    _distinct_children_deep_csr_kernel, _distinct_children_deep_csr_kernel_parallel
+)
+
+
+def _checked_distinct_children_deep(
+    offsets_in, global_parents, global_pdgs, dtype, n_threads
+):
+    _check_index_range(len(global_parents), dtype)
+    return _distinct_children_deep(
+        n_threads, offsets_in, global_parents, global_pdgs, dtype
+    )
+
+
+@accepts_offsets
+@accepts_kernel_options
+def distinct_children_deep(
+    counts,
+    global_parents,
+    global_pdgs,
+    offsets=None,
+    index_dtype=np.int64,
+    parallel_threads=None,
+):
     """Compute all distinct children, skipping children with same pdg id in between.
 
     Signature: offsets,global_parents,global_pdgs,!distinctChildrenDeep
-    Expects global indexes, flat arrays, which should be same length
+    Expects global indexes, flat arrays, which should be same length.
+    Already computed ``offsets`` of the ``counts`` can be passed to avoid converting them again.
+    The indices are of ``index_dtype`` (an ``OverflowError`` is raised if they do not fit).
+    With ``parallel_threads``, the kernel runs in parallel over events on that many threads.
     """
+    index_dtype = _checked_index_dtype(index_dtype)
+    _check_parallel_threads(parallel_threads)
     if not isinstance(
         global_parents.layout, awkward.contents.listoffsetarray.ListOffsetArray
     ):
@@ -683,7 +1088,8 @@ def distinct_children_deep(counts, global_parents, global_pdgs):
         global_pdgs.layout, awkward.contents.listoffsetarray.ListOffsetArray
     ):
         raise RuntimeError
-    offsets = counts2offsets(counts)
+    if offsets is None:
+        offsets = counts2offsets(counts)
 
     # Check if VirtualNDArray
     global_parents_data = None
@@ -695,19 +1101,24 @@ def distinct_children_deep(counts, global_parents, global_pdgs):
 
     # store offsets to later reapply them
     result_offsets = global_parents.layout.offsets
-    ccontent = _distinct_children_deep_kernel_content(
-        awkward.Array(awkward.contents.NumpyArray(offsets)),
-        awkward.Array(global_parents.layout.content),
-        awkward.Array(global_pdgs.layout.content),
-        data=global_parents_data,
+    # offsets and content come from a single pass of the kernel
+    offsets_kernel, content_kernel = _shared_outputs(_checked_distinct_children_deep, 2)
+    kernel_inputs = (
+        offsets,
+        global_parents.layout.content.data,
+        global_pdgs.layout.content.data,
+        index_dtype,
+        parallel_threads,
     )
-    ccontent = awkward.contents.NumpyArray(ccontent)
-    coffsets = _distinct_children_deep_kernel_offsets(
-        awkward.Array(awkward.contents.NumpyArray(offsets)),
-        awkward.Array(global_parents.layout.content),
-        awkward.Array(global_pdgs.layout.content),
-        awkward.Array(ccontent),
+    coffsets = offsets_kernel(
+        *kernel_inputs,
         data=global_parents_data,
+        length=_derived_length(
+            _buffer_length(global_parents.layout.content.data), lambda n: n + 1
+        ),
+    )
+    ccontent = awkward.contents.NumpyArray(
+        content_kernel(*kernel_inputs, data=global_parents_data, dtype=index_dtype)
     )
 
     out = awkward.contents.ListOffsetArray(
@@ -722,3 +1133,168 @@ def distinct_children_deep(counts, global_parents, global_pdgs):
             out,
         )
     )
+
+
+class Genealogy(tp.NamedTuple):
+    """Outputs of ``genealogy``, in the same layout as the outputs of the single kernels
+    (``children`` is the array of children that ``genealogy`` was given or computed)"""
+
+    distinct_parent: awkward.Array
+    children: awkward.Array
+    distinct_children: awkward.Array
+    distinct_children_deep: awkward.Array
+
+
+def _genealogy_kernel(
+    offsets_in,
+    global_parents,
+    global_pdgs,
+    child_offsets,
+    child_content,
+    dtype,
+    n_threads,
+):
+    _check_index_range(len(global_parents), dtype)
+    distinct_parents = _distinct_parent(
+        n_threads, offsets_in, global_parents, global_pdgs, dtype
+    )
+    return (
+        distinct_parents,
+        *_children(n_threads, offsets_in, distinct_parents, dtype),
+        # the deep pass walks the children of the parents, which are already computed
+        *_distinct_children_deep_csr(
+            n_threads,
+            offsets_in,
+            global_parents,
+            global_pdgs,
+            child_offsets,
+            child_content,
+            dtype,
+        ),
+    )
+
+
+@accepts_offsets
+@accepts_kernel_options
+def genealogy(
+    counts,
+    global_parents,
+    global_pdgs,
+    global_children=None,
+    offsets=None,
+    index_dtype=np.int64,
+    parallel_threads=None,
+):
+    """Compute ``distinct_parent``, ``children`` (of the distinct parents) and
+    ``distinct_children_deep`` at once, reusing the ``children`` of the parents
+
+    Signature: offsets,global_parents,global_pdgs,global_children,!genealogy
+    Expects global indexes, flat arrays, which should be same length.
+    ``global_children`` is the output of ``children`` for the same ``counts`` and ``global_parents``.
+    It is computed if it is not given, and its buffers are the children lists that
+    ``distinct_children_deep`` walks, so the children of the parents are only computed once.
+    Already computed ``offsets`` of the ``counts`` can be passed to avoid converting them again.
+    In the virtual case, all outputs are computed together when the first of them is materialized.
+    The indices are of ``index_dtype`` (an ``OverflowError`` is raised if they do not fit).
+    With ``parallel_threads``, the kernels run in parallel over events on that many threads.
+    """
+    index_dtype = _checked_index_dtype(index_dtype)
+    _check_parallel_threads(parallel_threads)
+    if not isinstance(
+        global_parents.layout, awkward.contents.listoffsetarray.ListOffsetArray
+    ):
+        raise RuntimeError
+    if not isinstance(
+        global_pdgs.layout, awkward.contents.listoffsetarray.ListOffsetArray
+    ):
+        raise RuntimeError
+    if offsets is None:
+        offsets = counts2offsets(counts)
+    if global_children is None:
+        global_children = children(
+            counts,
+            global_parents,
+            offsets=offsets,
+            index_dtype=index_dtype,
+            parallel_threads=parallel_threads,
+        )
+    if not isinstance(
+        global_children.layout.content, awkward.contents.listoffsetarray.ListOffsetArray
+    ):
+        raise RuntimeError
+
+    # Check if VirtualNDArray
+    global_parents_data = None
+    if not all(
+        awkward.to_layout(_).is_all_materialized
+        for _ in (counts, global_parents, global_pdgs, global_children)
+    ):
+        global_parents_data = global_parents.layout.content.data
+
+    # store offsets to later reapply them
+    result_offsets = global_parents.layout.offsets
+    # all outputs come from a single call of the kernel
+    kernel_inputs = (
+        offsets,
+        global_parents.layout.content.data,
+        global_pdgs.layout.content.data,
+        global_children.layout.content.offsets.data,
+        global_children.layout.content.content.data,
+        index_dtype,
+        parallel_threads,
+    )
+    # one distinct parent per particle, and one list of children per particle
+    n_particles = _buffer_length(global_parents.layout.content.data)
+    n_offsets = _derived_length(n_particles, lambda n: n + 1)
+    # the offsets of the children are int64, all indices are of the index dtype
+    outputs = [
+        output(*kernel_inputs, data=global_parents_data, dtype=dtype, length=length)
+        for output, dtype, length in zip(
+            _shared_outputs(_genealogy_kernel, 5),
+            (index_dtype, *(np.int64, index_dtype) * 2),
+            (n_particles, n_offsets, None, n_offsets, None),
+            strict=True,
+        )
+    ]
+
+    def _jagged(*buffers):
+        # reapply the offsets to a flat content or to (offsets, content) of a nested list
+        if len(buffers) == 1:
+            content = awkward.contents.NumpyArray(buffers[0])
+        else:
+            content = awkward.contents.ListOffsetArray(
+                awkward.index.Index64(buffers[0]),
+                awkward.contents.NumpyArray(buffers[1]),
+            )
+        return awkward.Array(awkward.contents.ListOffsetArray(result_offsets, content))
+
+    return Genealogy(
+        _jagged(outputs[0]),
+        global_children,
+        _jagged(*outputs[1:3]),
+        _jagged(*outputs[3:5]),
+    )
+
+
+def warmup(index_dtypes=(np.int16, np.int32, np.int64), parallel=False):
+    """Compile the index kernels for all ``index_dtypes`` ahead of time
+
+    The kernels are cached on disk (``cache=True``), so a fresh process only loads them, but
+    kernels for dtypes that were not seen yet are still compiled on first use. Calling this
+    once per worker (e.g. in a worker setup hook) moves that latency out of the first chunk.
+    The kernels are compiled for inputs and outputs (see ``NanoAOD.index_dtype``) of every
+    dtype. The parallel kernels (see ``NanoAOD.parallel_threads``) are compiled as well if ``parallel``.
+    """
+    offsets = np.zeros(1, dtype=np.int64)
+    pdgs = np.zeros(0, dtype=np.int32)
+    for index_dtype in index_dtypes:
+        index = np.zeros(0, dtype=index_dtype)
+        for dtype in map(np.dtype, index_dtypes):
+            _local2globalindex_kernel(offsets, index, offsets, dtype)
+            _distinct_parent_kernel(offsets, index, pdgs, dtype)
+            _children_kernel(offsets, index, dtype)
+            _distinct_children_deep_kernel(offsets, index, pdgs, dtype)
+            if parallel:
+                _distinct_parent_kernel_parallel(offsets, index, pdgs, dtype)
+                _children_kernel_parallel(offsets, index, dtype)
+                _distinct_children_deep_kernel_parallel(offsets, index, pdgs, dtype)
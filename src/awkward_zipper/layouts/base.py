@@ -1,3 +1,34 @@
+import bisect
+
+
+class _PrefixIndex:
+    """Sorted view of a set of field names, answering prefix queries by bisection
+
+    Looking up all fields that start with a prefix costs ``O(log n + k)`` instead of a
+    linear ``startswith`` scan, so grouping ``n`` fields into collections scales linearly.
+    """
+
+    def __init__(self, fields):
+        self._sorted = sorted(fields)
+
+    def startswith(self, prefix):
+        """All fields starting with ``prefix``, in sorted order"""
+        if not prefix:
+            return list(self._sorted)
+        lo = bisect.bisect_left(self._sorted, prefix)
+        # every string starting with ``prefix`` sorts before ``prefix`` with its last character incremented
+        hi = bisect.bisect_left(
+            self._sorted, prefix[:-1] + chr(ord(prefix[-1]) + 1), lo=lo
+        )
+        return self._sorted[lo:hi]
+
+    def discard(self, field):
+        """Remove ``field`` from the index, if present"""
+        i = bisect.bisect_left(self._sorted, field)
+        if i < len(self._sorted) and self._sorted[i] == field:
+            del self._sorted[i]
+
+
 class BaseLayoutBuilder:
     """Base class for all layout builders"""
 
@@ -1,24 +1,164 @@
+import collections
+import concurrent.futures
+import functools
+import graphlib
+import operator
+import threading
 import typing as tp
 import warnings
 
 import awkward
+import numpy as np
 
 from awkward_zipper.awkward_util import (
-    _check_equal_lengths,
-    _non_materializing_get_field,
-    _rewrap,
+    _ArraySource,
+    _buffer_paths,
+    _EagerBuilder,
+    _FormBuilder,
+    _FormSource,
+    _materialized_nbytes,
 )
 from awkward_zipper.kernels import (
+    OffsetsRegistry,
     children,
     counts2nestedindex,
-    counts2offsets,
-    distinct_children_deep,
-    distinct_parent,
     full_like_from_counts,
+    genealogy,
     local2globalindex,
     nestedindex,
 )
-from awkward_zipper.layouts.base import BaseLayoutBuilder
+from awkward_zipper.layouts.base import BaseLayoutBuilder, _PrefixIndex
+
+
+class _DerivedField(tp.NamedTuple):
+    """Node of the dependency graph of derived (new) fields
+
+    ``fcn(*inputs, *constants)`` builds the field, where every input is either the name of an
+    input branch (``str``) or the id of another derived field (``int``). If ``counts`` is set, the
+    shared offsets of that counts branch are passed to ``fcn`` as ``offsets`` keyword argument.
+    """
+
+    kind: str
+    fcn: tp.Callable
+    inputs: tuple
+    counts: str | None = None
+    constants: tuple = ()
+
+
+def _nestedindex(*indices):
+    return nestedindex(list(indices))
+
+
+def _branch(array):
+    return array
+
+
+def _prefetch(iterator, depth):
+    """Iterate over ``iterator``, while a background thread already fetches the next ``depth`` items"""
+    if depth < 1:
+        yield from iterator
+        return
+    end = object()
+    # a single worker, so that ``next`` is never called concurrently
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        pending = collections.deque(
+            executor.submit(next, iterator, end) for _ in range(depth)
+        )
+        while (item := pending.popleft().result()) is not end:
+            pending.append(executor.submit(next, iterator, end))
+            yield item
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+class _StepSizeTuner:
+    """Number of entries per chunk, adapted to a memory budget from the observed bytes per event
+
+    The estimate follows increases of the bytes per event immediately and decreases only gradually
+    (with exponential ``decay``), and the step size at most doubles from one chunk to the next.
+    """
+
+    def __init__(self, memory_budget, step_size, decay=0.5):
+        self.memory_budget = memory_budget
+        self.step_size = max(1, int(step_size))
+        self.bytes_per_event = None
+        self._decay = decay
+
+    def observe(self, n_events, nbytes):
+        """Update the step size after a chunk of ``n_events`` held ``nbytes`` of memory"""
+        if n_events == 0:
+            return
+        observed = nbytes / n_events
+        if self.bytes_per_event is None:
+            self.bytes_per_event = observed
+        else:
+            self.bytes_per_event = max(
+                observed,
+                self._decay * self.bytes_per_event + (1 - self._decay) * observed,
+            )
+        self.step_size = max(
+            1,
+            min(
+                2 * self.step_size,
+                int(self.memory_budget / max(self.bytes_per_event, 1)),
+            ),
+        )
+
+
+class _BuildPlan:
+    """Schema decisions of a layout builder for one set of input fields
+
+    Everything in here only depends on the field names (and on the schema class and version),
+    so a plan is compiled once and replayed on every chunk with the same set of branches.
+    """
+
+    def __init__(self):
+        self.missing_event_ids = []
+        # all ``n{collection}`` counts branches
+        self.counts_branches = frozenset()
+        # warnings are stored as messages and re-issued on every replay
+        self.crossref_warnings = []
+        self.warnings = []
+        # all declared derived fields, indexed by node id, and the names they were declared with
+        self.derived = []
+        self.derived_names = []
+        # ids of the derived fields reachable from the collections, in topological generations:
+        # the fields of one generation only depend on input branches and earlier generations
+        self.generations = []
+        # (name, kind, mixin, [(field, key)], [(node_id, key)])
+        self.collections = []
+        # all input branches that are read
+        self.branches = frozenset()
+
+
+class _BuildPlanCache:
+    """LRU cache of the build plans of one schema class, keyed on (version, requested columns,
+    frozenset of fields, kernel options)"""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._plans = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compile_plan):
+        """Fetch the plan for ``key``, calling ``compile_plan()`` on a miss"""
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+                return plan
+        plan = compile_plan()
+        with self._lock:
+            plan = self._plans.setdefault(key, plan)
+            self._plans.move_to_end(key)
+            while len(self._plans) > self.maxsize:
+                self._plans.popitem(last=False)
+        return plan
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
 
 
 class NanoAOD(BaseLayoutBuilder):
@@ -48,10 +188,28 @@ class NanoAOD(BaseLayoutBuilder):
 
     The same holds for ``error_missing_events_id``. If error_missing_events_id is true, then when the 'run', 'event',
     or 'luminosityBlock' fields are missing, an exception will be thrown; if it is false, just a warning will be issued.
+
+    All decisions that only depend on the branch names are compiled into a build plan, which is cached per
+    schema class and replayed on every later chunk with the same branches. Changes to the class-level
+    configuration are therefore only picked up for sets of fields that have not been seen yet.
+
+    The new fields are declared as a dependency graph, and only those that end up in a collection are built.
+    If ``executor`` is set, independent new fields are created on it in parallel.
+
+    The NanoEvents can be restricted to a list of ``columns``, e.g. ``NanoAOD(columns=["Muon.pt", "GenPart"])``.
+    Every other collection is skipped together with the new fields that only it needs, and
+    `required_branches` lists the input branches that the requested columns depend on.
     """
 
     warn_missing_crossrefs = True  # If True, issues a warning when a missing global index cross-ref target is encountered
     error_missing_event_ids = True  # If True, raises an exception when 'run', 'event', or 'luminosityBlock' fields are missing
+    executor = None  # If set to a concurrent.futures.Executor, independent new fields are created on it in parallel
+    # If set to a number of threads (at most numba.config.NUMBA_NUM_THREADS), the GenPart genealogy
+    # kernels split the events of a chunk across that many threads
+    parallel_threads = None
+    # Dtype of the index arrays created by the kernels (global indices, nested indices, GenPart genealogy):
+    # np.int32 or np.int16 save memory, as long as the global indices of a chunk fit (OverflowError otherwise)
+    index_dtype = np.int64
 
     event_ids: tp.ClassVar = ["run", "luminosityBlock", "event"]
     """List of NanoAOD event IDs
@@ -145,34 +303,45 @@ class NanoAOD(BaseLayoutBuilder):
     }
     """Nested collections, where nesting is accomplished by assuming the target can be unflattened according to a source counts"""
     special_items: tp.ClassVar = {
-        "GenPart_distinctParentIdxG": (
-            distinct_parent,
-            ("GenPart_genPartIdxMotherG", "GenPart_pdgId"),
-        ),
+        # the children only depend on the parents, and are reused by the genealogy
         "GenPart_childrenIdxG": (
             children,
+            ("nGenPart", "GenPart_genPartIdxMotherG"),
+        ),
+        # the GenPart genealogy indices that depend on the pdg ids are computed together
+        # (see ``kernels.genealogy``)
+        "_GenPart_genealogy": (
+            genealogy,
             (
                 "nGenPart",
                 "GenPart_genPartIdxMotherG",
+                "GenPart_pdgId",
+                "GenPart_childrenIdxG",
             ),
         ),
+        "GenPart_distinctParentIdxG": (
+            operator.attrgetter("distinct_parent"),
+            ("_GenPart_genealogy",),
+        ),
         "GenPart_distinctChildrenIdxG": (
-            children,
-            (
-                "nGenPart",
-                "GenPart_distinctParentIdxG",
-            ),
+            operator.attrgetter("distinct_children"),
+            ("_GenPart_genealogy",),
         ),
         "GenPart_distinctChildrenDeepIdxG": (
-            distinct_children_deep,
-            (
-                "nGenPart",
-                "GenPart_genPartIdxMotherG",
-                "GenPart_pdgId",
-            ),
+            operator.attrgetter("distinct_children_deep"),
+            ("_GenPart_genealogy",),
         ),
     }
-    """Special arrays, where the callable and input arrays are specified in the value"""
+    """Special arrays, where the callable and input arrays are specified in the value
+
+    Inputs can be input branches or other new fields (including other special arrays, in any order).
+    If the first input is a counts branch (``n{collection}``) and the callable is marked with
+    ``kernels.accepts_offsets``, it is also passed the shared offsets of that branch as ``offsets``
+    keyword argument. Callables marked with ``kernels.accepts_kernel_options`` are passed the kernel
+    options of the builder (``index_dtype`` and ``parallel_threads``) as keyword arguments. Items whose
+    name does not start with a collection name (e.g. ``_GenPart_genealogy``) are not part of any
+    collection, but can be inputs of others.
+    """
     full_like_items: tp.ClassVar = {
         "Photon_mass": ("nPhoton", 0.0),
         "Photon_charge": ("nPhoton", 0.0),
@@ -202,8 +371,19 @@ class NanoAOD(BaseLayoutBuilder):
     }
     """Arrays that should be aliased to ensure proper 4-vector behavior"""
 
-    def __init__(self, version="latest"):
+    mixin_fields: tp.ClassVar = ["pt", "eta", "phi", "mass", "charge", "x", "y", "z"]
+    """Fields that are always kept (if present) in a collection restricted by ``columns``, since the mixins need them"""
+
+    _build_plans: tp.ClassVar = _BuildPlanCache()
+    """LRU cache of the compiled build plans, one per schema class"""
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._build_plans = _BuildPlanCache()
+
+    def __init__(self, version="latest", columns=None):
         self._version = version
+        self._columns = None if columns is None else frozenset(columns)
         self.cross_references = dict(self.all_cross_references)
         if version == "latest":
             pass
@@ -250,14 +430,58 @@ class NanoAOD(BaseLayoutBuilder):
         """
         return cls(version="5")
 
-    def __call__(self, array: awkward.Array) -> awkward.Array:
-        fields = set(array.fields)
+    def _parse_columns(self):
+        """Requested columns as a mapping from collection name to requested keys (None: all keys)"""
+        selection = {}
+        for column in self._columns:
+            name, _, key = column.partition(".")
+            if not key:
+                selection[name] = None
+            elif name not in selection or selection[name] is not None:
+                selection.setdefault(name, set()).add(key)
+        return selection
+
+    def required_branches(self, fields) -> set:
+        """Input branches that are read to build NanoEvents from the input ``fields``
+
+        With ``columns``, this is the dependency closure of the requested columns, e.g. requesting
+        ``GenPart.distinctChildren`` needs ``nGenPart``, ``GenPart_genPartIdxMother`` and ``GenPart_pdgId``.
+        It can be used to read only the necessary branches, e.g. with ``filter_name`` in ``uproot``.
+        """
+        return set(self._build_plan(fields).branches)
+
+    def _build_plan(self, fields) -> _BuildPlan:
+        """Fetch the build plan for a set of input fields from the LRU cache of the class (compiling it
+        with this builder on a miss)"""
+        fields = frozenset(fields)
+        kernel_options = (
+            ("index_dtype", np.dtype(self.index_dtype)),
+            ("parallel_threads", self.parallel_threads),
+        )
+        return self._build_plans.get(
+            (self._version, self._columns, fields, kernel_options),
+            lambda: self._compile_build_plan(fields, kernel_options),
+        )
+
+    def _compile_build_plan(self, fields, kernel_options) -> _BuildPlan:
+        """Compile the build plan for a set of input fields
+
+        This performs all the per-schema decisions of the layout construction (collection
+        grouping, event-id check, cross-reference existence checks, mixin lookup, ...) on the
+        field names only, so that the result can be cached and replayed for every chunk with
+        the same set of branches. The ``kernel_options`` ((name, value) pairs) are bound to the kernels.
+        """
+        fields = set(fields)
+        kernel_options = dict(kernel_options)
+        plan = _BuildPlan()
 
-        def _get_collection_fields(name, collection):
-            return set(filter(lambda f: f.startswith(name), collection))
+        # sorted index of the field names: every prefix lookup below is a bisection
+        # instead of a linear scan over all fields
+        field_index = _PrefixIndex(fields)
 
         # branches that start with "n"
-        counter_fields = _get_collection_fields("n", fields)
+        counter_fields = set(field_index.startswith("n"))
+        plan.counts_branches = frozenset(counter_fields)
 
         # parse into high-level records (collections, list collections, and singletons)
         # Split on the first _ to get the collection prefix — e.g. "Electron_pt" → "Electron"
@@ -273,7 +497,7 @@ class NanoAOD(BaseLayoutBuilder):
             for name in collections:
                 # check collections that have only one instance in each event
                 if "n" + name not in fields:
-                    collection_counts = _get_collection_fields("n" + name + "_", fields)
+                    collection_counts = field_index.startswith("n" + name + "_")
                     # if however, the fields of this collection have multiple instances in each event
                     # then we use these fields as collections instead
                     # Example: 'nProton_multiRP' and 'nProton_singleRP' fields are present but no 'nProton' field
@@ -295,294 +519,762 @@ class NanoAOD(BaseLayoutBuilder):
         # check if data or simulation
         is_data = "GenPart" not in collections
 
-        new_fields = {}
-        # # Create offsets virtual arrays
-        # for name in counter_fields:
-        #     arr = _non_materializing_get_field(array, name)
-        #     new_fields[name.replace("n", "o", 1)] = counts2offsets(arr)
-
         # Check the presence of the event_ids
-        missing_event_ids = [
+        plan.missing_event_ids = [
             event_id for event_id in self.event_ids if event_id not in fields
         ]
-        if len(missing_event_ids) > 0:
-            if self.error_missing_event_ids:
-                msg = f"There are missing event ID fields: {missing_event_ids} \n\n\
-                    The event ID fields {self.event_ids} are necessary to perform sub-run identification \
-                    (e.g. for corrections and sub-dividing data during different detector conditions),\
-                    to cross-validate MC and Data (i.e. matching events for comparison), and to generate event displays. \
-                    It's advised to never drop these branches from the dataformat.\n\n\
-                    This error can be demoted to a warning by setting the class level variable error_missing_event_ids to False."
-                raise RuntimeError(msg)
-            warnings.warn(
-                f"Missing event_ids : {missing_event_ids}",
-                RuntimeWarning,
-                stacklevel=2,
-            )
 
-        # Create global index virtual arrays for indirection
+        # derived fields form a dependency graph: ``derived`` holds the nodes and ``new_fields``
+        # maps the name of every new field to the id of the node that builds it
+        derived = plan.derived
+        new_fields = {}
+        # (branch, message) pairs, so that warnings about skipped collections can be dropped
+        crossref_warnings = []
+        other_warnings = []
+
+        def _add(name, node):
+            derived.append(node)
+            plan.derived_names.append(name)
+            new_fields[name] = len(derived) - 1
+
+        def _ref(name):
+            # a derived field shadows an input branch of the same name
+            return new_fields.get(name, name)
+
+        # Global index arrays for indirection
         for indexer, target in self.all_cross_references.items():
             if target.startswith("Gen") and is_data:
                 continue
             if indexer not in fields:
-                if self.warn_missing_crossrefs:
-                    warnings.warn(
+                crossref_warnings.append(
+                    (
+                        indexer,
                         f"Missing cross-reference index for {indexer} => {target}",
-                        RuntimeWarning,
-                        stacklevel=2,
                     )
+                )
                 continue
             if "n" + target not in fields:
-                if self.warn_missing_crossrefs:
-                    warnings.warn(
+                crossref_warnings.append(
+                    (
+                        indexer,
                         f"Missing cross-reference target for {indexer} => {target}",
-                        RuntimeWarning,
-                        stacklevel=2,
                     )
+                )
                 continue
-            # convert nWhatever to a global index
             # this used to be transforms.counts2offsets_form + transforms.local2global_form in coffea
-            arr_indexer = _non_materializing_get_field(array, indexer)
-            arr_target = _non_materializing_get_field(array, "n" + target)
-            new_fields[indexer + "G"] = local2globalindex(arr_indexer, arr_target)
+            _add(
+                indexer + "G",
+                _DerivedField(
+                    "global_index",
+                    functools.partial(
+                        local2globalindex, index_dtype=kernel_options["index_dtype"]
+                    ),
+                    (indexer, "n" + target),
+                    counts="n" + target,
+                ),
+            )
 
-        # Create nested indexer from Idx1, Idx2, ... arrays
+        # Nested indexer from Idx1, Idx2, ... arrays
         for name, indexers in self.nested_items.items():
             if all(idx in new_fields for idx in indexers):
-                new_fields[name] = nestedindex(
-                    [_non_materializing_get_field(new_fields, idx) for idx in indexers]
+                _add(
+                    name,
+                    _DerivedField(
+                        "nested_index",
+                        _nestedindex,
+                        tuple(new_fields[idx] for idx in indexers),
+                    ),
                 )
 
-        # Create nested indexer from n* counts arrays
+        # Nested indexer from n* counts arrays
         for name, (local_counts, target) in self.nested_index_items.items():
             if local_counts in fields and "n" + target in fields:
-                arr_local_counts = _non_materializing_get_field(array, local_counts)
-                arr_target = _non_materializing_get_field(array, "n" + target)
                 # this used to be transforms.counts2nestedindex_form + transforms.local2global_form in coffea
-                new_fields[name] = counts2nestedindex(arr_local_counts, arr_target)
-
-        # Create any special arrays
-        for name, (fcn, args) in self.special_items.items():
-            if all((k in new_fields or k in fields) for k in args):
-                # shortened code: (_non_materializing_get_field(new_fields if k in new_fields else array, k) for k in args)
-                input_arrays = ()
-                for k in args:
-                    input_arrays += (
-                        _non_materializing_get_field(
-                            new_fields if k in new_fields else array, k
+                _add(
+                    name,
+                    _DerivedField(
+                        "counts_nested_index",
+                        functools.partial(
+                            counts2nestedindex,
+                            index_dtype=kernel_options["index_dtype"],
                         ),
-                    )
-                new_fields[name] = fcn(*input_arrays)
+                        (local_counts, "n" + target),
+                        counts="n" + target,
+                    ),
+                )
+
+        # Special arrays, which may depend on each other (in any declaration order):
+        # add every item whose inputs are available until no more items can be added
+        pending = dict(self.special_items)
+        while pending:
+            ready = [
+                name
+                for name, (_, args) in pending.items()
+                if all((k in new_fields or k in fields) for k in args)
+            ]
+            if not ready:
+                break
+            for name in ready:
+                fcn, args = pending.pop(name)
+                _add(
+                    name,
+                    _DerivedField(
+                        "special",
+                        functools.partial(fcn, **kernel_options)
+                        if getattr(fcn, "accepts_kernel_options", False)
+                        else fcn,
+                        tuple(_ref(k) for k in args),
+                        # a counts branch as first input: share its offsets as well,
+                        # if the callable accepts them (see ``kernels.accepts_offsets``)
+                        counts=args[0]
+                        if args[0] in counter_fields
+                        and getattr(fcn, "accepts_offsets", False)
+                        else None,
+                    ),
+                )
 
-        # Create full-like arrays (constant-valued branches needed by 4-vectors)
+        # Full-like arrays (constant-valued branches needed by 4-vectors)
         for name, (counts_branch, fill_value) in self.full_like_items.items():
             if counts_branch in fields:
                 if name in fields or name in new_fields:
-                    warnings.warn(
-                        f"Branch {name} already exists but its values will be replaced with {fill_value}",
-                        RuntimeWarning,
-                        stacklevel=2,
+                    other_warnings.append(
+                        (
+                            name,
+                            f"Branch {name} already exists but its values will be replaced with {fill_value}",
+                        )
                     )
-                new_fields[name] = full_like_from_counts(
-                    _non_materializing_get_field(array, counts_branch), fill_value
+                _add(
+                    name,
+                    _DerivedField(
+                        "full_like",
+                        full_like_from_counts,
+                        (counts_branch,),
+                        counts=counts_branch,
+                        constants=(fill_value,),
+                    ),
                 )
 
-        # Rename arrays (e.g. to avoid clashing with a mixin-provided field)
+        # Renamed arrays (e.g. to avoid clashing with a mixin-provided field)
         for new_name, old_name in self.rename_items.items():
             if old_name in fields or old_name in new_fields:
                 if new_name in fields or new_name in new_fields:
-                    warnings.warn(
-                        f"Branch {new_name} already exists but it will be replaced with {old_name}",
-                        RuntimeWarning,
-                        stacklevel=2,
+                    other_warnings.append(
+                        (
+                            new_name,
+                            f"Branch {new_name} already exists but it will be replaced with {old_name}",
+                        )
                     )
                 if old_name in new_fields:
                     new_fields[new_name] = new_fields.pop(old_name)
                 else:
-                    new_fields[new_name] = _non_materializing_get_field(array, old_name)
                     fields.discard(old_name)
+                    field_index.discard(old_name)
+                    _add(new_name, _DerivedField("branch", _branch, (old_name,)))
 
-        # Alias arrays (make a branch available under another name)
+        # Aliased arrays (make a branch available under another name)
         for alias_name, original_name in self.alias_items.items():
             if original_name in fields or original_name in new_fields:
                 if (
                     alias_name in fields or alias_name in new_fields
                 ) and alias_name != "CorrT1METJet_mass":
-                    warnings.warn(
-                        f"Branch {alias_name} already exists but it will be replaced with {original_name}",
-                        RuntimeWarning,
-                        stacklevel=2,
+                    other_warnings.append(
+                        (
+                            alias_name,
+                            f"Branch {alias_name} already exists but it will be replaced with {original_name}",
+                        )
                     )
                 if original_name in new_fields:
                     new_fields[alias_name] = new_fields[original_name]
                 else:
-                    new_fields[alias_name] = _non_materializing_get_field(
-                        array, original_name
-                    )
+                    _add(alias_name, _DerivedField("branch", _branch, (original_name,)))
 
-        output = {}
+        # requested collections and their requested fields (None: all fields)
+        selection = None if self._columns is None else self._parse_columns()
+        unmatched = set() if selection is None else set(self._columns)
+
+        new_field_index = _PrefixIndex(new_fields)
         for name in collections:
+            if (
+                selection is not None
+                and name not in selection
+                and name not in self.event_ids
+            ):
+                continue
             name_with_underscore = name + "_"
             mixin = self.mixins.get(name, "NanoCollection")
             if "n" + name in fields and name not in fields:
-                content = {}
-                # buffers in `array`
-                for field in _get_collection_fields(name_with_underscore, fields):
-                    arr = _non_materializing_get_field(array, field)
+                kind = "jagged"
+            elif ("n" + name) in fields:
+                kind = "list_singleton"
+            elif name in fields:
+                kind = "singleton"
+            else:
+                kind = "table"
+            collection_fields = [
+                (field, field.removeprefix(name_with_underscore))
+                for field in field_index.startswith(name_with_underscore)
+            ]
+            collection_new_fields = []
+            if kind == "jagged":
+                collection_new_fields = [
+                    (new_fields[field], field.removeprefix(name_with_underscore))
+                    for field in new_field_index.startswith(name_with_underscore)
+                ]
+            elif kind == "table":
+                # a flat table takes the renamed and aliased input branches (e.g. ``MET_pt`` in ScoutingNanoAOD)
+                collection_new_fields = [
+                    (new_fields[field], field.removeprefix(name_with_underscore))
+                    for field in new_field_index.startswith(name_with_underscore)
+                    if derived[new_fields[field]].kind == "branch"
+                    and isinstance(derived[new_fields[field]].inputs[0], str)
+                ]
+            keys = None if selection is None else selection.get(name)
+            if keys is not None:
+                # a requested key matches a field of the same name or its global index (``{key}IdxG``)
+                def _requested(key, name=name, keys=keys):
+                    for column in (key, key.removesuffix("IdxG")):
+                        if column in keys:
+                            unmatched.discard(f"{name}.{column}")
+                            return True
+                    return key in self.mixin_fields
+
+                collection_fields = [
+                    (field, key) for field, key in collection_fields if _requested(key)
+                ]
+                collection_new_fields = [
+                    (node_id, key)
+                    for node_id, key in collection_new_fields
+                    if _requested(key)
+                ]
+            if keys is None:
+                # the whole collection is built, so all its columns are matched
+                unmatched.difference_update(
+                    [c for c in unmatched if c.partition(".")[0] == name]
+                )
+            plan.collections.append(
+                (name, kind, mixin, collection_fields, collection_new_fields)
+            )
 
-                    *_, buffers = awkward.to_buffers(arr)
-                    assert {"node0-offsets", "node1-data"} == set(buffers)
-                    # take flat data
-                    content[field.removeprefix(name_with_underscore)] = (
-                        awkward.contents.NumpyArray(
-                            buffers["node1-data"],
-                            parameters=arr.layout.parameters,
-                        )
-                    )
+        if unmatched:
+            msg = f"Requested columns not found in the input branches: {sorted(unmatched)}"
+            raise ValueError(msg)
 
-                # new buffers in `new_fields`
-                for field in _get_collection_fields(name_with_underscore, new_fields):
-                    arr = _non_materializing_get_field(new_fields, field)
-                    parameters = arr.layout.parameters
-                    *_, buffers = awkward.to_buffers(arr)
-                    if field in self.nested_items | self.nested_index_items | dict(
-                        list(self.special_items.items())[1:]
-                    ):
-                        # doubly-jagged case
-                        assert {"node0-offsets", "node1-offsets", "node2-data"} == set(
-                            buffers
-                        )
-                        # take singly jagged array
-                        content[field.removeprefix(name_with_underscore)] = (
-                            awkward.contents.ListOffsetArray(
-                                offsets=awkward.index.Index(buffers["node1-offsets"]),
-                                content=awkward.contents.NumpyArray(
-                                    buffers["node2-data"]
-                                ),
-                                parameters=parameters,
-                            )
-                        )
-                    else:
-                        assert {"node0-offsets", "node1-data"} == set(buffers)
-                        # take flat data
-                        content[field.removeprefix(name_with_underscore)] = (
-                            awkward.contents.NumpyArray(
-                                buffers["node1-data"], parameters=parameters
-                            )
-                        )
+        # warnings about collections that are not built are dropped
+        built = {name for name, *_ in plan.collections}
+        plan.crossref_warnings = [
+            message
+            for branch, message in crossref_warnings
+            if selection is None or branch.split("_", maxsplit=1)[0] in built
+        ]
+        plan.warnings = [
+            message
+            for branch, message in other_warnings
+            if selection is None or branch.split("_", maxsplit=1)[0] in built
+        ]
+
+        # only the derived fields that end up in a collection (and their dependencies) are built,
+        # shared intermediates once; fields of the same generation are independent of each other
+        outputs = {
+            node_id
+            for *_, collection_new_fields in plan.collections
+            for node_id, _ in collection_new_fields
+        }
+        graph = {}
+        stack = list(outputs)
+        while stack:
+            node_id = stack.pop()
+            if node_id in graph:
+                continue
+            graph[node_id] = [
+                dep for dep in derived[node_id].inputs if isinstance(dep, int)
+            ]
+            stack.extend(graph[node_id])
+        sorter = graphlib.TopologicalSorter(graph)
+        sorter.prepare()
+        while sorter.is_active():
+            generation = tuple(sorted(sorter.get_ready()))
+            plan.generations.append(generation)
+            sorter.done(*generation)
+
+        # input branches read by the plan
+        plan.branches = frozenset(
+            {
+                field
+                for *_, collection_fields, collection_new_fields in plan.collections
+                # input branches replaced by a new field of the same key are not read
+                for field, key in collection_fields
+                if all(key != new_key for _, new_key in collection_new_fields)
+            }
+            | {"n" + name for name, kind, *_ in plan.collections if kind == "jagged"}
+            | {
+                name
+                for name, kind, *_ in plan.collections
+                if kind in ("list_singleton", "singleton")
+            }
+            | {
+                k
+                for node_id in graph
+                for k in (*derived[node_id].inputs, derived[node_id].counts)
+                if isinstance(k, str)
+            }
+        )
+
+        return plan
+
+    def __call__(self, array: awkward.Array) -> awkward.Array:
+        """Build NanoEvents from an ``awkward.Array`` record of flat branches
+
+        This is usually the output of ``uproot``'s ``TTree.arrays`` (eager or with ``virtual=True``).
+        """
+        return self._from_array(array, stacklevel=4)
+
+    def _from_array(self, array, stacklevel) -> awkward.Array:
+        """``__call__``, with warnings attributed to the frame ``stacklevel`` levels up from ``_build``"""
+        source = _ArraySource(array)
+        if awkward.to_layout(array).is_all_materialized:
+            # eager input: the layout is assembled right away from the buffers in memory
+            return self._build(source, _EagerBuilder(), stacklevel=stacklevel)
+        return self._build(source, stacklevel=stacklevel)
+
+    def from_form(self, form, length: int, buffer_provider: tp.Any) -> awkward.Array:
+        """Build NanoEvents from the Form of the flat branches, without an intermediate array
+
+        Parameters
+        ----------
+            form: awkward.forms.RecordForm (or its dict/JSON representation)
+                Form of the record of flat branches, as it would be returned by ``TTree.arrays``. Only the
+                node types produced by uproot (numpy, list-offset, regular and record) are supported, a
+                ``TypeError`` is raised for option-type, indexed, union, ... nodes
+            length: int
+                Number of entries (events)
+            buffer_provider: Mapping or Callable
+                Either a mapping from buffer keys (``"{form_key}-{attribute}"``, like the container of
+                ``awkward.from_buffers``) to arrays or generators, or a callable that takes a buffer key
+                and returns the array. Buffers are only fetched when they are materialized, so any
+                storage backend (ROOT, an in-memory cache, ...) can be plugged in.
 
-                _content = (*content.values(),)
-                _fields = (*content.keys(),)
-                _length = _check_equal_lengths(_content)
+        Returns
+        -------
+            out: awkward.Array
+                NanoEvents
+        """
+        return self._build(_FormSource(form, length, buffer_provider), stacklevel=3)
+
+    def iterate(
+        self,
+        tree_or_files,
+        step_size: int | str = "100 MB",
+        prefetch: int = 1,
+        memory_budget: int | str | None = None,
+        **options,
+    ) -> tp.Iterator[awkward.Array]:
+        """Iterate over NanoEvents in chunks of entries, reading the next chunks in the background
+
+        While the NanoEvents of one chunk are processed, a background thread already reads (and
+        decompresses) the baskets of the next ``prefetch`` chunks, so that I/O and compute overlap.
+
+        Parameters
+        ----------
+            tree_or_files:
+                An ``uproot`` TTree, or any files specification accepted by ``uproot.iterate``
+                (e.g. ``"nano_dy.root:Events"``)
+            step_size: int or str
+                Number of entries per chunk, or the memory size of a chunk (e.g. ``"100 MB"``)
+            prefetch: int
+                Number of chunks to read ahead (0 reads every chunk only when it is needed)
+            memory_budget: int or str, optional
+                Memory (e.g. ``"2 GB"``) for all chunks in flight (the current one and the prefetched ones).
+                If given, the number of entries per chunk is tuned between chunks: after every chunk has been
+                processed, the bytes per event held by the input branches and by all materialized buffers of
+                its NanoEvents (including derived ones, e.g. children and nested indices) are measured, and the
+                following chunks are sized to fit the budget. ``step_size`` is then only the first guess, and
+                ``entry_start``/``entry_stop`` apply to every TTree.
+            options:
+                Passed to ``uproot``'s ``iterate``, e.g. ``entry_start``, ``entry_stop`` or ``filter_name``.
+                With ``columns``, a TTree is filtered to the `required_branches` by default.
+
+        Yields
+        ------
+            out: awkward.Array
+                NanoEvents of one chunk
+        """
+        import uproot
 
-                # combine contents in a RecordArray
-                record = awkward.contents.RecordArray(
-                    _content, _fields, length=_length, parameters={}
+        options.setdefault("ak_add_doc", True)
+        if memory_budget is not None:
+            yield from self._iterate_tuned(
+                tree_or_files, step_size, prefetch, memory_budget, options
+            )
+            return
+        if isinstance(tree_or_files, uproot.behaviors.TBranch.HasBranches):
+            if self._columns is not None:
+                options.setdefault(
+                    "filter_name", sorted(self.required_branches(tree_or_files.keys()))
                 )
-                # update parameters
-                counts = _non_materializing_get_field(array, "n" + name)
-                record.parameters.update(
-                    {
-                        "collection_name": name,
-                        "__record__": mixin,
-                        "__doc__": counts.layout.parameters.get("__doc__"),
-                    }
+            chunks = tree_or_files.iterate(step_size=step_size, library="ak", **options)
+        else:
+            chunks = uproot.iterate(
+                tree_or_files, step_size=step_size, library="ak", **options
+            )
+        for array in _prefetch(chunks, prefetch):
+            yield self._from_array(array, stacklevel=4)
+
+    def _iterate_tuned(
+        self, tree_or_files, step_size, prefetch, memory_budget, options
+    ):
+        """`iterate` with the number of entries per chunk tuned to a memory budget"""
+        import uproot
+
+        no_filter = uproot.behaviors.TBranch.no_filter
+        if isinstance(tree_or_files, (str, dict, uproot.behaviors.TBranch.HasBranches)):
+            tree_or_files = [tree_or_files]
+        entry_start = options.pop("entry_start", None) or 0
+        entry_stop = options.pop("entry_stop", None)
+        # every chunk in flight gets its share of the budget
+        tuner = _StepSizeTuner(
+            uproot._util.memory_size(memory_budget) / (1 + max(prefetch, 0)), 1
+        )
+
+        def _chunks():
+            for tree_or_file in tree_or_files:
+                tree = tree_or_file
+                if not isinstance(tree, uproot.behaviors.TBranch.HasBranches):
+                    tree = uproot.open(tree_or_file)
+                tree_options = dict(options)
+                if self._columns is not None:
+                    tree_options.setdefault(
+                        "filter_name", sorted(self.required_branches(tree.keys()))
+                    )
+                start = entry_start
+                stop = tree.num_entries
+                if entry_stop is not None:
+                    stop = min(stop, entry_stop)
+                if tuner.bytes_per_event is None:
+                    # first guess, until the first chunk is measured
+                    tuner.step_size = max(
+                        1,
+                        step_size
+                        if isinstance(step_size, int)
+                        else tree.num_entries_for(
+                            step_size,
+                            filter_name=tree_options.get("filter_name", no_filter),
+                            entry_start=start,
+                            entry_stop=stop,
+                        ),
+                    )
+                while start < stop:
+                    # the step size is read when the chunk is requested, i.e. with
+                    # the estimate of the latest chunk that was processed
+                    chunk_stop = min(stop, start + tuner.step_size)
+                    yield tree.arrays(
+                        entry_start=start,
+                        entry_stop=chunk_stop,
+                        library="ak",
+                        **tree_options,
+                    )
+                    start = chunk_stop
+
+        for array in _prefetch(_chunks(), prefetch):
+            events = self._from_array(array, stacklevel=5)
+            yield events
+            # measured once the chunk has been processed
+            tuner.observe(len(array), _materialized_nbytes(array, events))
+
+    def dry_run(self, function: tp.Callable, form) -> tuple[set, set]:
+        """Find the input branches and derived fields that ``function`` needs, without reading any data
+
+        The NanoEvents are built from the Form of the input branches only, as an ``awkward`` typetracer,
+        and ``function`` (e.g. an analysis processor) is run on them. Every buffer whose data it touched
+        is traced back to the input branch or the derived field it comes from, so that only the necessary
+        branches can be read before any I/O happens.
+
+        Parameters
+        ----------
+            function: Callable
+                Function that takes NanoEvents, e.g. ``lambda events: events.Muon.pt[events.Muon.pt > 10]``
+            form: awkward.forms.RecordForm (or its dict/JSON representation) or awkward.Array
+                Form of the record of flat branches (or a record of flat branches, e.g. ``uproot``'s
+                ``TTree.arrays`` with ``virtual=True``, whose Form is taken)
+
+        Returns
+        -------
+            out: tuple[set, set]
+                Names of the input branches, and names of the derived fields (e.g. ``GenPart_distinctChildrenIdxG``),
+                that ``function`` needs, including all the branches and fields the derived fields are computed from
+                (and the event IDs and the `mixin_fields` of the collections in use)
+        """
+        if isinstance(form, awkward.Array):
+            form = awkward.to_layout(form).form
+
+        def _no_data(key):
+            msg = f"dry run must not read buffer {key}"
+            raise AssertionError(msg)
+
+        source = _FormSource(form, 0, _no_data)
+        plan = self._build_plan(source.fields)
+        builder, events_form = self._build_form(source, plan)
+        layout, report = awkward.typetracer.typetracer_with_report(events_form)
+        events = awkward.Array(layout, behavior=self.behavior())
+        events.attrs["@original_array"] = events
+        function(events)
+
+        # the event IDs are always needed to build NanoEvents
+        branches = {
+            event_id for event_id in self.event_ids if event_id in source.fields
+        }
+        derived = set()
+        stack = [builder.origins[form_key] for form_key in report.data_touched]
+        while stack:
+            origin = stack.pop()
+            if isinstance(origin, str):
+                branches.add(origin)
+            elif plan.derived_names[origin] not in derived:
+                node = plan.derived[origin]
+                derived.add(plan.derived_names[origin])
+                stack.extend(node.inputs)
+                if node.counts is not None:
+                    stack.append(node.counts)
+        # the mixins of the collections in use validate that their fields are present
+        for name, _, _, collection_fields, _ in plan.collections:
+            if "n" + name in branches or any(
+                field in branches for field, _ in collection_fields
+            ):
+                branches.update(
+                    field
+                    for field, key in collection_fields
+                    if key in self.mixin_fields
+                )
+        return branches, derived
+
+    def shared_buffers(self, array) -> list[tuple[str, ...]]:
+        """Buffers of the NanoEvents that share a single materialization
+
+        Buffers that hold the same data, e.g. a branch and its alias in ``alias_items``, are materialized
+        only once and the resulting array is shared between them.
+        A virtual ``array`` (or a Form) is not read.
+
+        Parameters
+        ----------
+            array: awkward.Array or awkward.forms.RecordForm (or its dict/JSON representation)
+                Record of flat branches (e.g. ``uproot``'s ``TTree.arrays`` with ``virtual=True``),
+                or the Form of the record of flat branches with the form keys of its buffers
+
+        Returns
+        -------
+            out: list[tuple[str, ...]]
+                Groups of buffers that are shared, every buffer named by the path of its node in the
+                NanoEvents and its attribute, e.g. ``("CorrT1METJet.rawPt-data", "CorrT1METJet.pt-data")``
+        """
+        if isinstance(array, awkward.Array):
+            source = _ArraySource(array)
+        else:
+
+            def _no_data(key):
+                msg = f"shared_buffers must not read buffer {key}"
+                raise AssertionError(msg)
+
+            source = _FormSource(array, 0, _no_data)
+        builder, events_form = self._build_form(source, self._build_plan(source.fields))
+        paths = dict(_buffer_paths(events_form))
+        return [tuple(paths[key] for key in keys) for keys in builder.shared.values()]
+
+    def _build(self, source, builder=None, stacklevel=3) -> awkward.Array:
+        """NanoEvents of ``source``
+
+        Warnings are attributed to the frame ``stacklevel`` levels up (3: the caller of the public
+        method that calls ``_build``).
+        """
+        plan = self._build_plan(source.fields)
+
+        if len(plan.missing_event_ids) > 0:
+            missing_event_ids = plan.missing_event_ids
+            if self.error_missing_event_ids:
+                msg = f"There are missing event ID fields: {missing_event_ids} \n\n\
+                    The event ID fields {self.event_ids} are necessary to perform sub-run identification \
+                    (e.g. for corrections and sub-dividing data during different detector conditions),\
+                    to cross-validate MC and Data (i.e. matching events for comparison), and to generate event displays. \
+                    It's advised to never drop these branches from the dataformat.\n\n\
+                    This error can be demoted to a warning by setting the class level variable error_missing_event_ids to False."
+                raise RuntimeError(msg)
+            warnings.warn(
+                f"Missing event_ids : {missing_event_ids}",
+                RuntimeWarning,
+                stacklevel=stacklevel,
+            )
+        if self.warn_missing_crossrefs:
+            for message in plan.crossref_warnings:
+                warnings.warn(message, RuntimeWarning, stacklevel=stacklevel)
+        for message in plan.warnings:
+            warnings.warn(message, RuntimeWarning, stacklevel=stacklevel)
+
+        builder, form = self._build_form(source, plan, builder)
+        nanoevents = builder.to_array(form, source.length, behavior=self.behavior())
+
+        # add ref to itself in attrs
+        nanoevents.attrs["@original_array"] = nanoevents
+
+        return nanoevents
+
+    def _build_form(
+        self, source, plan, builder=None
+    ) -> tuple[_FormBuilder, awkward.forms.Form]:
+        """Final Form of the NanoEvents, and the ``_FormBuilder`` holding its buffers
+
+        The origin of every buffer is either the name of an input branch or the id of a derived field.
+        If an ``_EagerBuilder`` is given as ``builder``, the final layout is returned instead of its Form.
+        """
+        # offsets of every counts branch are created (and materialized) only once
+        # and shared by all kernels and by the jagged collections
+        offsets = OffsetsRegistry(source.array)
+
+        # Create the derived fields, one topological generation at a time
+        new_fields = {}
+
+        def _evaluate(node_id):
+            node = plan.derived[node_id]
+            inputs = (
+                new_fields[k] if isinstance(k, int) else source.array(k)
+                for k in node.inputs
+            )
+            if node.counts is None:
+                return node.fcn(*inputs, *node.constants)
+            return node.fcn(*inputs, *node.constants, offsets=offsets[node.counts])
+
+        for generation in plan.generations:
+            if self.executor is None or len(generation) == 1:
+                for node_id in generation:
+                    new_fields[node_id] = _evaluate(node_id)
+            else:
+                new_fields.update(
+                    zip(
+                        generation,
+                        self.executor.map(_evaluate, generation),
+                        strict=True,
+                    )
                 )
 
-                # wrap as jagged array
-                offsets = counts2offsets(counts)
-                offsets = awkward.index.Index(offsets)
-                output[name] = awkward.contents.ListOffsetArray(
-                    offsets=offsets, content=record
+        # the final layout is emitted directly as a Form plus its buffers, and created with a
+        # single ``awkward.from_buffers`` call at the end (or assembled right away if eager)
+        if builder is None:
+            builder = _FormBuilder()
+        output = {}
+        for (
+            name,
+            kind,
+            mixin,
+            collection_fields,
+            collection_new_fields,
+        ) in plan.collections:
+            if kind == "jagged":
+                content = {}
+                # input branches
+                for field, key in collection_fields:
+                    assert isinstance(source.form(field), awkward.forms.ListOffsetForm)
+                    # take flat data
+                    builder.origin = field
+                    content[key] = source.register(builder, field, content=True)
+
+                # new branches in `new_fields`
+                for node_id, key in collection_new_fields:
+                    layout = new_fields[node_id].layout
+                    assert isinstance(layout, awkward.contents.ListOffsetArray)
+                    builder.origin = node_id
+                    node = plan.derived[node_id]
+                    if node.kind == "branch" and isinstance(node.inputs[0], str):
+                        # renamed or aliased input branch: registered like the input branch itself,
+                        # so that an alias shares the buffers of its original branch
+                        content[key] = source.register(
+                            builder, node.inputs[0], content=True
+                        )
+                        continue
+                    # take flat data (or the singly jagged array in the doubly-jagged case)
+                    content[key] = builder.layout(
+                        layout.content, parameters=layout.parameters
+                    )
+
+                # wrap the record as jagged array
+                builder.origin = "n" + name
+                output[name] = builder.list_offset(
+                    offsets["n" + name],
+                    builder.record(
+                        content.values(),
+                        content.keys(),
+                        parameters={
+                            "collection_name": name,
+                            "__record__": mixin,
+                            "__doc__": source.form("n" + name).parameters.get(
+                                "__doc__"
+                            ),
+                        },
+                    ),
                 )
-            elif ("n" + name) in fields:
+            elif kind == "list_singleton":
                 # list singleton (can use branch's own offsets)
-                arr = _non_materializing_get_field(array, name)
-                output[name] = awkward.to_layout(arr)
-                output[name].parameters.update(
-                    {"__array__": mixin, "collection_name": name}
+                builder.origin = name
+                output[name] = source.register(
+                    builder,
+                    name,
+                    parameters={
+                        **source.form(name).parameters,
+                        "__array__": mixin,
+                        "collection_name": name,
+                    },
                 )
-            elif name in fields:
+            elif kind == "singleton":
                 # singleton
-                arr = _non_materializing_get_field(array, name)
-                output[name] = awkward.to_layout(arr)
+                builder.origin = name
+                output[name] = source.register(builder, name)
             else:
                 # simple collection
                 content = {}
-                offsets = None
-                for field in _get_collection_fields(name_with_underscore, fields):
-                    arr = _non_materializing_get_field(array, field)
-
-                    *_, buffers = awkward.to_buffers(arr)
-                    if {"node0-offsets", "node1-data"} == set(buffers):
+                table_offsets = None
+                # renamed or aliased input branches are registered like the input branch itself,
+                # so that an alias shares the buffers of its original branch
+                aliases = [
+                    (plan.derived[node_id].inputs[0], key)
+                    for node_id, key in collection_new_fields
+                ]
+                for field, key in collection_fields + aliases:
+                    form = source.form(field)
+                    builder.origin = field
+                    if isinstance(form, awkward.forms.ListOffsetForm):
                         # RNTuple: fields are already jagged (ListOffsetArray)
-                        if offsets is None:
-                            offsets = buffers["node0-offsets"]
-                        content[field.removeprefix(name_with_underscore)] = (
-                            awkward.contents.NumpyArray(
-                                buffers["node1-data"],
-                                parameters=arr.layout.parameters,
-                            )
-                        )
+                        if table_offsets is None:
+                            table_offsets = (source.offsets(field), form.offsets, field)
+                        content[key] = source.register(builder, field, content=True)
                     else:
-                        assert {"node0-data"} == set(buffers)
+                        assert isinstance(form, awkward.forms.NumpyForm)
                         # take flat data
-                        content[field.removeprefix(name_with_underscore)] = (
-                            awkward.contents.NumpyArray(
-                                buffers["node0-data"],
-                                parameters=arr.layout.parameters,
-                            )
-                        )
-
-                _content = (*content.values(),)
-                _fields = (*content.keys(),)
-                _length = _check_equal_lengths(_content)
+                        content[key] = source.register(builder, field)
 
-                record = awkward.contents.RecordArray(
-                    _content, _fields, length=_length, parameters={}
-                )
-                record.parameters.update(
-                    {
+                record = builder.record(
+                    content.values(),
+                    content.keys(),
+                    parameters={
                         "collection_name": name,
                         "__record__": mixin,
-                    }
+                    },
                 )
-
-                if offsets is not None:
-                    output[name] = awkward.contents.ListOffsetArray(
-                        offsets=awkward.index.Index(offsets),
-                        content=record,
+                if table_offsets is not None:
+                    builder.origin = table_offsets[2]
+                    output[name] = builder.list_offset(
+                        table_offsets[0], record, index=table_offsets[1]
                     )
                 else:
                     output[name] = record
 
         # final nanoevents (most outer) zip
-        _content = (*output.values(),)
-        _fields = (*output.keys(),)
-        _length = int(awkward.num(array, axis=0))
-
-        nanoevents = awkward.Array(
-            awkward.contents.RecordArray(_content, _fields, length=_length),
-            behavior=self.behavior(),
-        )
-
-        # fix virtual array shape generators by re-running from buffers:
-        nanoevents = awkward.with_name(
-            _rewrap(nanoevents),
-            name="NanoEvents",
-        )
-        # add aditional parameters
-        nanoevents.layout.parameters.update(
-            {
+        form = builder.record(
+            output.values(),
+            output.keys(),
+            parameters={
+                "__record__": "NanoEvents",
+                # add aditional parameters
                 "metadata": {"version": self._version},
-                **array.layout.parameters,
-            }
+                **source.parameters,
+            },
         )
-
-        # add ref to itself in attrs
-        nanoevents.attrs["@original_array"] = nanoevents
-
-        return nanoevents
+        return builder, form
 
     @classmethod
     def behavior(cls):
@@ -1,9 +1,16 @@
+import typing as tp
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
 import awkward
+import numba
+import numpy as np
 import uproot
-from coffea.nanoevents import NanoAODSchema, NanoEventsFactory
+from coffea.nanoevents import NanoAODSchema, NanoEventsFactory, PFNanoAODSchema
 from test_parameters import compare_parameters
 
-from awkward_zipper import NanoAOD
+from awkward_zipper import NanoAOD, PFNanoAOD, kernels
+from awkward_zipper.awkward_util import _ArraySource
 
 # load a test root file
 file_name = "tests/samples/nano_dy.root"
@@ -29,9 +36,13 @@ def test_nano_dy_whole():
     # test across coffea (constructed from the same nano_dy.root file)
 
     # awkward-zipper adds some additional parameters, so check_parameters=False
+    # nested indices are regular lists in awkward-zipper (and var lists in coffea)
     # also there are some arrays consisting of nans, so use equal_nan=True
     assert awkward.array_equal(
-        zipper_array, coffea_array, check_parameters=False, equal_nan=True
+        awkward.from_regular(zipper_array, axis=None),
+        coffea_array,
+        check_parameters=False,
+        equal_nan=True,
     )
 
 
@@ -47,19 +58,19 @@ def test_nano_dy_kernels():
 
     # test nestedindex function
     # nestedindex function in awkward-zipper adds to the parameters, that it outputs an array nested from two index arrays
-    assert awkward.array_equal(
-        zipper_array.FatJet.subJetIdxG,
-        coffea_array.FatJet.subJetIdxG,
-        check_parameters=False,
-    )
-    assert awkward.array_equal(
-        zipper_array.Jet.muonIdxG, coffea_array.Jet.muonIdxG, check_parameters=False
-    )
-    assert awkward.array_equal(
-        zipper_array.Jet.electronIdxG,
-        coffea_array.Jet.electronIdxG,
-        check_parameters=False,
-    )
+    # with one entry per index array, so the nested lists are regular
+    for collection, field in (
+        ("FatJet", "subJetIdxG"),
+        ("Jet", "muonIdxG"),
+        ("Jet", "electronIdxG"),
+    ):
+        nested = zipper_array[collection][field]
+        assert isinstance(nested.layout.content, awkward.contents.RegularArray)
+        assert awkward.array_equal(
+            awkward.from_regular(nested, axis=-1),
+            coffea_array[collection][field],
+            check_parameters=False,
+        )
     print(awkward.materialize(zipper_array.FatJet.subJetIdxG))
     print(awkward.materialize(zipper_array.Jet.muonIdxG))
     print(awkward.materialize(zipper_array.Jet.electronIdxG))
@@ -93,6 +104,212 @@ def test_nano_dy_kernels():
     print(awkward.materialize(zipper_array.GenPart.distinctChildrenDeepIdxG))
 
 
+def test_pfnano_nested_index():
+    # counts2nestedindex on eager inputs (PFNano's nested_index_items)
+    pfnano_file_name = "tests/samples/pfnano.root"
+    pfnano_array = PFNanoAOD()(uproot.open(pfnano_file_name)["Events"].arrays())
+    pfnano_coffea_array = NanoEventsFactory.from_root(
+        {pfnano_file_name: "Events"},
+        schemaclass=PFNanoAODSchema,
+        mode="eager",
+    ).events()
+    assert awkward.array_equal(
+        pfnano_array.Jet.pFCandsIdxG,
+        pfnano_coffea_array.Jet.pFCandsIdxG,
+        check_parameters=False,
+    )
+
+
+class ParallelNanoAOD(NanoAOD):
+    parallel_threads = numba.config.NUMBA_NUM_THREADS
+
+
+def test_parallel_kernels():
+    # the parallel genealogy kernels give the same results as the serial ones
+    parallel_array = ParallelNanoAOD()(array)
+    for field in (
+        "distinctParentIdxG",
+        "childrenIdxG",
+        "distinctChildrenIdxG",
+        "distinctChildrenDeepIdxG",
+    ):
+        assert awkward.array_equal(
+            parallel_array.GenPart[field], coffea_array.GenPart[field]
+        )
+    # the setting is captured in the build plan (and does not leak into other builders)
+    plans = {
+        builder: builder._build_plan(array.fields)
+        for builder in (restructure, ParallelNanoAOD())
+    }
+    for builder, plan in plans.items():
+        node = plan.derived[plan.derived_names.index("_GenPart_genealogy")]
+        assert node.fcn.keywords["parallel_threads"] == builder.parallel_threads
+
+
+def test_warmup():
+    # all index dtypes are compiled ahead of time
+    kernels.warmup()
+    compiled = {
+        signature[1].dtype.name
+        for signature in kernels._local2globalindex_kernel.signatures
+    }
+    assert {"int16", "int32", "int64"} <= compiled
+
+
+def test_eager_builder():
+    # eager inputs are assembled right away from the Numpy buffers, without virtual arrays
+    layout = zipper_array.layout
+    assert isinstance(layout.content("Jet").content.content("pt").data, np.ndarray)
+    assert isinstance(
+        layout.content("GenPart").content.content("childrenIdxG").content.data,
+        np.ndarray,
+    )
+    # the same NanoEvents as built with a Form and awkward.from_buffers
+    assert awkward.array_equal(
+        zipper_array,
+        restructure._build(_ArraySource(array)),
+        equal_nan=True,
+    )
+    # a sliced input gives the same NanoEvents as reading the slice
+    assert awkward.array_equal(
+        restructure(array[5:17]),
+        restructure(tree.arrays(entry_start=5, entry_stop=17, ak_add_doc=True)),
+        check_parameters=False,
+        equal_nan=True,
+    )
+
+
+def test_build_plan_cache():
+    # chunks with the same set of branches replay the same compiled build plan
+    plan = restructure._build_plan(array.fields)
+    assert restructure._build_plan(reversed(array.fields)) is plan
+    assert NanoAOD(version="7")._build_plan(array.fields) is not plan
+    assert awkward.array_equal(
+        restructure(array), zipper_array, check_parameters=False, equal_nan=True
+    )
+
+
+class PlainElectronNanoAOD(NanoAOD):
+    def __init__(self, plain_electrons, **kwargs):
+        super().__init__(**kwargs)
+        if plain_electrons:
+            self.mixins = {**self.mixins, "Electron": "PtEtaPhiMCollection"}
+
+
+def test_build_plan_subclass():
+    # the build plan is compiled by the builder that is called, so a subclass with its own
+    # __init__ arguments works and its instance configuration is honored
+    builder = PlainElectronNanoAOD(plain_electrons=True)
+    plan = builder._build_plan(array.fields)
+    assert builder._build_plan(array.fields) is plan
+    assert restructure._build_plan(array.fields) is not plan
+    plain_array = builder(array)
+    assert plain_array.Electron.layout.content.parameter("__record__") == (
+        "PtEtaPhiMCollection"
+    )
+    assert zipper_array.Electron.layout.content.parameter("__record__") == "Electron"
+    assert awkward.array_equal(plain_array.Electron.pt, zipper_array.Electron.pt)
+
+
+def test_derived_fields_graph():
+    # special items may depend on each other in any declaration order,
+    # and independent new fields can be created in parallel
+    class ReversedNanoAOD(NanoAOD):
+        special_items: tp.ClassVar = dict(reversed(NanoAOD.special_items.items()))
+
+    plan = ReversedNanoAOD()._build_plan(array.fields)
+    for i, generation in enumerate(plan.generations):
+        for node_id in generation:
+            dependencies = [
+                k for k in plan.derived[node_id].inputs if isinstance(k, int)
+            ]
+            assert all(k in sum(plan.generations[:i], ()) for k in dependencies)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        ReversedNanoAOD.executor = executor
+        result = ReversedNanoAOD()(array)
+    assert awkward.array_equal(
+        result, zipper_array, check_parameters=False, equal_nan=True
+    )
+
+
+def test_special_items_callable():
+    # any callable can be a special item, the shared offsets are only passed to marked kernels
+    def has_mother(counts, parents):
+        assert len(counts) == len(parents)
+        return parents >= 0
+
+    class CustomNanoAOD(NanoAOD):
+        special_items: tp.ClassVar = {
+            **NanoAOD.special_items,
+            "GenPart_hasMother": (has_mother, ("nGenPart", "GenPart_genPartIdxMother")),
+        }
+
+    result = CustomNanoAOD()(array)
+    assert awkward.array_equal(
+        result.GenPart.hasMother,
+        coffea_array.GenPart.genPartIdxMother >= 0,
+        check_parameters=False,
+    )
+
+
+def test_warnings_stacklevel():
+    # the warnings about the input branches are attributed to the caller
+    for build in (
+        lambda: restructure(array),
+        lambda: restructure.from_form(*awkward.to_buffers(array)),
+        lambda: next(restructure.iterate(tree, step_size=100, prefetch=0)),
+        lambda: next(
+            restructure.iterate(tree, prefetch=0, memory_budget="20 MB", step_size=5)
+        ),
+    ):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            build()
+        messages = [w for w in caught if "cross-reference" in str(w.message)]
+        assert len(messages) > 0
+        assert all(w.filename == __file__ for w in messages)
+
+
+def test_iterate():
+    # chunks of NanoEvents, read ahead in the background
+    chunks = list(restructure.iterate(tree, step_size=15, prefetch=2))
+    assert [len(chunk) for chunk in chunks] == [15, 15, 10]
+    for i, chunk in enumerate(chunks):
+        # global indices are relative to the chunk
+        array_chunk = tree.arrays(
+            entry_start=15 * i, entry_stop=15 * (i + 1), ak_add_doc=True
+        )
+        assert awkward.array_equal(
+            chunk, restructure(array_chunk), check_parameters=False, equal_nan=True
+        )
+    # a files specification is passed to uproot.iterate
+    chunks = restructure.iterate(f"{file_name}:Events", step_size=100, prefetch=0)
+    assert awkward.array_equal(
+        next(chunks), zipper_array, check_parameters=False, equal_nan=True
+    )
+
+
+def test_iterate_memory_budget():
+    # the entries per chunk follow the measured bytes per event
+    lengths = []
+    for chunk in restructure.iterate(
+        tree, step_size=5, prefetch=0, memory_budget="200 kB"
+    ):
+        awkward.materialize(chunk.GenPart.distinctChildrenIdxG)
+        lengths.append(len(chunk))
+    assert sum(lengths) == len(array)
+    assert lengths[0] == 5
+    assert len(set(lengths)) > 1
+    # a larger budget allows larger chunks
+    assert max(lengths) < max(
+        len(chunk)
+        for chunk in restructure.iterate(
+            tree, step_size=5, prefetch=0, memory_budget="20 MB"
+        )
+    )
+
+
 def test_behaviors():
     # behavior of coffea and zipper should be the same
     # except for Systematics, since they are not included in zipper
@@ -131,4 +348,15 @@ def test_behaviors():
 if __name__ == "__main__":
     test_nano_dy_whole()
     test_nano_dy_kernels()
+    test_pfnano_nested_index()
+    test_parallel_kernels()
+    test_warmup()
+    test_eager_builder()
+    test_build_plan_cache()
+    test_build_plan_subclass()
+    test_derived_fields_graph()
+    test_special_items_callable()
+    test_warnings_stacklevel()
+    test_iterate()
+    test_iterate_memory_budget()
     test_behaviors()
@@ -0,0 +1,153 @@
+import awkward
+import numba
+import numpy as np
+import pytest
+
+from awkward_zipper import kernels
+
+
+def test_local2globalindex_mismatched_events():
+    # the index and the target counts have to be of the same number of events
+    index = awkward.Array([[0], [1, 0], [2], [0]])
+    counts = awkward.Array(np.array([3, 3], dtype=np.int32))
+    with pytest.raises(ValueError, match="does not match"):
+        kernels.local2globalindex(index, counts)
+
+    counts = awkward.Array(np.array([3, 3, 3, 1], dtype=np.int32))
+    assert kernels.local2globalindex(index, counts).tolist() == [
+        [0],
+        [4, 3],
+        [8],
+        [9],
+    ]
+
+
+def test_parallel_threads_restored():
+    # the number of threads of numba in the calling thread is restored after a parallel kernel
+    calls = []
+    set_num_threads, get_num_threads = numba.set_num_threads, numba.get_num_threads
+    numba.set_num_threads = calls.append
+    numba.get_num_threads = lambda: 7
+    try:
+        counts = awkward.Array(np.array([3], dtype=np.int32))
+        parents = awkward.Array([[-1, 0, 0]])
+        result = kernels.children(counts, parents, parallel_threads=1)
+    finally:
+        numba.set_num_threads, numba.get_num_threads = set_num_threads, get_num_threads
+    assert result.tolist() == [[[1, 2], [], []]]
+    assert calls == [1, 7]
+
+
+def test_distinct_parent():
+    # the first parent with a different pdg id, through same-pdg chains, for the serial and the parallel kernel
+    parents = awkward.Array(
+        [
+            # a -1 parent and a same-pdg chain
+            [-1, 0, 1, 2, 3],
+            # forward references (to particles later in the event)
+            [6, 8, -1, 7],
+            # a parent outside of the event, which continues the same-pdg chain of event 0
+            [2, 9],
+        ]
+    )
+    pdgs = awkward.Array([[21, 1, 1, 1, 2], [11, 11, 22, 11], [1, 3]])
+    expected = [[-1, 0, 0, 0, 3], [7, 7, -1, 7], [0, 9]]
+    for parallel_threads in (None, 1):
+        result = kernels.distinct_parent(
+            parents, pdgs, parallel_threads=parallel_threads
+        )
+        assert result.tolist() == expected
+
+        # parent indices with the same pdg id that form a cycle, within the event or through
+        # a parent outside of it, or a particle that is its own parent
+        for cycle_parents, cycle_pdgs in (
+            ([[1, 0]], [[1, 1]]),
+            ([[1], [0]], [[1], [1]]),
+            ([[0]], [[1]]),
+        ):
+            with pytest.raises(RuntimeError, match="cycle"):
+                kernels.distinct_parent(
+                    awkward.Array(cycle_parents),
+                    awkward.Array(cycle_pdgs),
+                    parallel_threads=parallel_threads,
+                )
+
+
+def test_children():
+    # the children later in the same event (and a particle that is its own parent), in ascending order
+    parents = awkward.Array(
+        [
+            [-1, 0, 0, 1, 3],
+            # a forward reference (5 -> 6) is not a child, 7 is its own parent
+            [6, 5, 7],
+            # many children of one particle
+            [-1] + [8] * 40,
+        ]
+    )
+    counts = awkward.num(parents)
+    expected = [
+        [[1, 2], [3], [], [4], []],
+        [[6], [], [7]],
+        [list(range(9, 49))] + [[]] * 40,
+    ]
+    for parallel_threads in (None, 1):
+        result = kernels.children(counts, parents, parallel_threads=parallel_threads)
+        assert result.tolist() == expected
+
+
+def test_distinct_children_deep():
+    # the distinct children of the head of every same-pdg chain: its children with another pdg id,
+    # in ascending order, followed by the members of the chain without children, in ascending order
+    parents = awkward.Array(
+        [
+            # a short chain: 2 and 3 have the pdg id of 1, 4 and 5 do not
+            [-1, 0, 1, 2, 2, 3],
+            # a chain of 40 members (2 to 41), each with a child of another pdg id (42 to 81),
+            # which are reached in descending order
+            [-1, 0, *range(1, 41), *range(41, 1, -1)],
+            # a chain without children of 40 members (4 to 43), which are reached in the order
+            # 24 to 43 (children of 2) and 4 to 23 (children of 3)
+            [-1, 0, 1, 1, *[3] * 20, *[2] * 20],
+        ]
+    )
+    pdgs = awkward.Array(
+        [
+            [2212, 21, 21, 21, 1, 2],
+            [2212, *[21] * 41, *[1] * 40],
+            [2212, *[21] * 43],
+        ]
+    )
+    # global indices
+    parents = parents + awkward.Array([0, 6, 88]) * (parents >= 0)
+    counts = awkward.num(parents)
+    expected = [
+        [[], [4, 5], [], [], [], []],
+        [[], list(range(48, 88))] + [[]] * 80,
+        [[], list(range(92, 132))] + [[]] * 42,
+    ]
+    for parallel_threads in (None, 1):
+        result = kernels.distinct_children_deep(
+            counts, parents, pdgs, parallel_threads=parallel_threads
+        )
+        assert result.tolist() == expected
+        # the same from the children that the genealogy shares
+        genealogy = kernels.genealogy(
+            counts, parents, pdgs, parallel_threads=parallel_threads
+        )
+        assert genealogy.distinct_children_deep.tolist() == expected
+
+        with pytest.raises(RuntimeError, match="beyond length"):
+            kernels.distinct_children_deep(
+                awkward.Array(np.array([2], dtype=np.int32)),
+                awkward.Array([[-1, 5]]),
+                awkward.Array([[1, 2]]),
+                parallel_threads=parallel_threads,
+            )
+
+
+if __name__ == "__main__":
+    test_local2globalindex_mismatched_events()
+    test_parallel_threads_restored()
+    test_distinct_parent()
+    test_children()
+    test_distinct_children_deep()
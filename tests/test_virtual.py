@@ -1,9 +1,12 @@
 import awkward
+import numpy as np
+import pytest
 import uproot
-from coffea.nanoevents import NanoAODSchema, NanoEventsFactory
+from coffea.nanoevents import NanoAODSchema, NanoEventsFactory, ScoutingNanoAODSchema
 from test_parameters import compare_parameters
 
-from awkward_zipper import NanoAOD
+from awkward_zipper import NanoAOD, ScoutingNanoAOD, kernels
+from awkward_zipper.awkward_util import _materialized_nbytes
 
 # load a test root file
 file_name = "tests/samples/nano_dy.root"
@@ -44,37 +47,370 @@ def test_nano_dy_whole():
     # test across coffea (constructed from the same nano_dy.root file)
 
     # awkward-zipper adds some additional parameters, so check_parameters=False
+    # nested indices are regular lists in awkward-zipper (and var lists in coffea)
     # also there are some arrays consisting of nans, so use equal_nan=True
     assert awkward.array_equal(
-        zipper_array, coffea_array, check_parameters=False, equal_nan=True
+        awkward.from_regular(zipper_array, axis=None),
+        coffea_array,
+        check_parameters=False,
+        equal_nan=True,
     )
 
 
-def test_nano_dy_kernels():
-    # test local2globalindex function
-    # local2globalindex function in awkward-zipper adds to the parameters, that it outputs a global index array
+def test_from_form():
+    # build from the Form of the branches and a buffer provider, without an intermediate array
+    form, length, container = awkward.to_buffers(tree.arrays(ak_add_doc=True))
+    requested_keys = []
+
+    def buffer_provider(key):
+        requested_keys.append(key)
+        return container[key]
+
+    events = restructure.from_form(form, length, buffer_provider)
+    # buffers are only fetched once they are materialized
+    assert len(requested_keys) == 0
     assert awkward.array_equal(
-        zipper_array.Jet.electronIdx1G,
-        coffea_array.Jet.electronIdx1G,
+        awkward.from_regular(events, axis=None),
+        coffea_array,
         check_parameters=False,
+        equal_nan=True,
     )
-    print(awkward.materialize(zipper_array.Jet.electronIdx1G))
+    assert len(requested_keys) > 0
 
-    # test nestedindex function
-    # nestedindex function in awkward-zipper adds to the parameters, that it outputs an array nested from two index arrays
+
+def test_from_form_unsupported():
+    # only the flat, non-option forms produced by uproot are supported
+    base = tree.arrays(["nMuon", "Muon_pt", "run"], entry_stop=5)
+    for array in (
+        # an option-type branch
+        awkward.with_field(base, awkward.mask(base.run, base.run > 0), "run"),
+        # an indexed branch
+        awkward.with_field(
+            base,
+            awkward.contents.IndexedArray(
+                awkward.index.Index64(np.array([1, 0, 2, 4, 3])), base.run.layout
+            ),
+            "run",
+        ),
+    ):
+        form, length, container = awkward.to_buffers(array)
+        with pytest.raises(TypeError, match="only the flat, non-option forms"):
+            restructure.from_form(form, length, container)
+
+
+def test_shared_offsets():
+    # all consumers of a counts branch share one offsets buffer
+    genpart = restructure(tree.arrays(virtual=True)).GenPart
+    offsets = genpart.layout.offsets.data.materialize()
+    assert genpart.pt.layout.offsets.data.materialize() is offsets
+    assert genpart.childrenIdxG.layout.offsets.data.materialize() is offsets
+
+
+def test_shared_genealogy():
+    # the GenPart genealogy indices that depend on the pdg ids are all computed by a single
+    # kernel call on first touch, which reuses the children of the parents
+    calls = []
+    csr_calls = []
+    genealogy_kernel = kernels._genealogy_kernel
+    children_csr = kernels._children_csr_serial
+
+    def _counting_kernel(*arrays):
+        calls.append(arrays)
+        return genealogy_kernel(*arrays)
+
+    def _counting_csr(*arrays):
+        csr_calls.append(arrays)
+        return children_csr(*arrays)
+
+    kernels._genealogy_kernel = _counting_kernel
+    kernels._children_csr_serial = _counting_csr
+    try:
+        genpart = restructure(tree.arrays(virtual=True)).GenPart
+        assert len(calls) == 0
+        for field in (
+            "distinctParentIdxG",
+            "childrenIdxG",
+            "distinctChildrenIdxG",
+            "distinctChildrenDeepIdxG",
+        ):
+            assert awkward.array_equal(genpart[field], coffea_array.GenPart[field])
+        assert len(calls) == 1
+        # the children of the parents and of the distinct parents
+        assert len(csr_calls) == 2
+    finally:
+        kernels._genealogy_kernel = genealogy_kernel
+        kernels._children_csr_serial = children_csr
+
+    # the children do not depend on the pdg ids
+    branches = NanoAOD(columns=["GenPart.children"]).required_branches(tree.keys())
+    assert "GenPart_genPartIdxMother" in branches
+    assert "GenPart_pdgId" not in branches
+
+
+def test_known_lengths():
+    # the lengths of kernel outputs are known without running the kernels (or reading their other inputs)
+    access_log = []
+    branches = tree.arrays(virtual=True, access_log=access_log)
+    offsets = kernels.counts2offsets(branches.nJet)
+    global_index = kernels.local2globalindex(
+        branches.Jet_electronIdx1, branches.nElectron
+    )
+    distinct_parent = kernels.distinct_parent(
+        kernels.local2globalindex(branches.GenPart_genPartIdxMother, branches.nGenPart),
+        branches.GenPart_pdgId,
+    )
+    assert offsets.shape == (len(branches) + 1,)
+    assert len(access_log) == 0
+    assert global_index.layout.content.length == awkward.count(array.Jet_electronIdx1)
+    assert distinct_parent.layout.content.length == awkward.sum(array.nGenPart)
+    assert {access.branch for access in access_log} == {
+        "Jet_electronIdx1",
+        "GenPart_genPartIdxMother",
+    }
+
+
+def test_materialized_inputs():
+    # the kernels only materialize the buffers that they consume
+    access_log = []
+    branches = tree.arrays(virtual=True, access_log=access_log)
+    nested = kernels.nestedindex(
+        [
+            kernels.local2globalindex(branches.FatJet_subJetIdx1, branches.nSubJet),
+            kernels.local2globalindex(branches.FatJet_subJetIdx2, branches.nSubJet),
+        ]
+    )
+    # the nested index has no inner offsets, and its content only needs the index contents
+    assert isinstance(nested.layout.content, awkward.contents.RegularArray)
+    assert len(access_log) == 0
+    nested.layout.content.content.data.materialize()
+    assert {access.branch for access in access_log} == {
+        "FatJet_subJetIdx1",
+        "FatJet_subJetIdx2",
+        "nSubJet",
+    }
+    assert awkward.array_equal(
+        nested, zipper_array.FatJet.subJetIdxG, check_parameters=False
+    )
+
+
+class Int16NanoAOD(NanoAOD):
+    index_dtype = np.int16
+
+
+def test_index_dtype():
+    # narrower index dtypes give the same indices (and cross-references)
+    events = Int16NanoAOD()(tree.arrays(virtual=True))
+    # the dtype is captured when the (virtual) arrays are built
+    default_events = restructure(tree.arrays(virtual=True))
+    assert default_events.FatJet.subJetIdxG.layout.content.content.dtype == np.int64
+    assert events.GenPart.distinctChildrenIdxG.layout.content.content.dtype == np.int16
+    assert events.FatJet.subJetIdxG.layout.content.content.dtype == np.int16
+    materialized = awkward.materialize(events.Muon.genPartIdxG)
+    assert materialized.layout.content.data.dtype == np.int16
+    for collection, field in (
+        ("GenPart", "distinctParentIdxG"),
+        ("GenPart", "distinctChildrenDeepIdxG"),
+        ("Jet", "electronIdxG"),
+        ("Muon", "genPartIdxG"),
+    ):
+        assert awkward.array_equal(
+            awkward.from_regular(events[collection][field], axis=-1),
+            coffea_array[collection][field],
+            dtype_exact=False,
+            check_parameters=False,
+        )
     assert awkward.array_equal(
-        zipper_array.FatJet.subJetIdxG,
-        coffea_array.FatJet.subJetIdxG,
+        events.GenPart.distinctChildren.pt,
+        coffea_array.GenPart.distinctChildren.pt,
         check_parameters=False,
     )
+    # global indices beyond the range of the dtype
+    counts = awkward.Array(np.full(2, 20000, dtype=np.int32))
+    index = awkward.Array([[0], [1]])
+    with pytest.raises(OverflowError):
+        kernels.local2globalindex(index, counts, index_dtype=np.int16)
+
+
+def test_constant_columns():
+    # full_like_items are zero-stride views, and the 4-vector behaviors work on them
+    events = restructure(tree.arrays(virtual=True))
+    for collection, field in (
+        ("Photon", "mass"),
+        ("Jet", "charge"),
+        ("TrigObj", "mass"),
+    ):
+        constant = awkward.materialize(events[collection][field]).layout.content.data
+        assert constant.strides == (0,)
+        assert not constant.flags.writeable
+        assert len(constant) == awkward.sum(array[f"n{collection}"])
+    # the measured memory of a constant column is that of its offsets and a single value
+    jet_charge = awkward.materialize(events.Jet.charge)
+    assert _materialized_nbytes(jet_charge) == jet_charge.layout.offsets.data.nbytes + 4
+    for collection in ("Photon", "Jet"):
+        assert awkward.array_equal(
+            events[collection].charge, coffea_array[collection].charge
+        )
+        pairs = awkward.combinations(events[collection], 2)
+        coffea_pairs = awkward.combinations(coffea_array[collection], 2)
+        assert awkward.array_equal(
+            (pairs["0"] + pairs["1"]).mass,
+            (coffea_pairs["0"] + coffea_pairs["1"]).mass,
+            check_parameters=False,
+        )
+
+
+def test_shared_buffers():
+    # an aliased branch shares the materialization of its original branch
+    access_log = []
+    branches = tree.arrays(virtual=True, access_log=access_log)
+    shared = [("CorrT1METJet.rawPt-data", "CorrT1METJet.pt-data")]
+    assert restructure.shared_buffers(branches) == shared
+    assert len(access_log) == 0
+    events = restructure(branches)
+    raw_pt = awkward.materialize(events.CorrT1METJet.rawPt).layout.content.data
+    reads = len(access_log)
+    pt = awkward.materialize(events.CorrT1METJet.pt).layout.content.data
+    assert len(access_log) == reads
+    assert np.shares_memory(raw_pt, pt)
+
+    # the same for a Form and a buffer provider
+    form, length, container = awkward.to_buffers(array)
+    requested = []
+
+    def buffer_provider(key):
+        requested.append(key)
+        return container[key]
+
+    assert restructure.shared_buffers(form) == shared
+    events = restructure.from_form(form, length, buffer_provider)
+    awkward.materialize(events.CorrT1METJet[["pt", "rawPt"]])
+    assert len(requested) == len(set(requested))
+
+
+def test_table_aliases():
+    # aliases of the branches of a flat table (MET) are part of the table and share its buffers
+    access_log = []
+    branches = tree.arrays(
+        filter_name=lambda name: name not in ("MET_pt", "MET_phi"),
+        virtual=True,
+        access_log=access_log,
+    )
+    shared = ScoutingNanoAOD().shared_buffers(branches)
+    assert ("MET.fiducialGenPt-data", "MET.pt-data") in shared
+    assert ("MET.fiducialGenPhi-data", "MET.phi-data") in shared
+    met = ScoutingNanoAOD()(branches).MET
+    fiducial_pt = awkward.materialize(met.fiducialGenPt).layout.data
+    reads = len(access_log)
+    pt = awkward.materialize(met.pt).layout.data
+    assert len(access_log) == reads
+    assert np.shares_memory(fiducial_pt, pt)
+
+    # the same MET as in coffea (where the aliases replace the existing branches)
+    scouting_coffea_array = NanoEventsFactory.from_root(
+        {file_name: "Events"},
+        schemaclass=ScoutingNanoAODSchema,
+        mode="eager",
+    ).events()
+    with pytest.warns(RuntimeWarning, match="MET_pt already exists"):
+        scouting_array = ScoutingNanoAOD()(tree.arrays(virtual=True))
+    assert awkward.array_equal(
+        scouting_array.MET, scouting_coffea_array.MET, check_parameters=False
+    )
+
+
+def test_sliced_input():
+    # a slice of virtual branches gives the same NanoEvents as reading only its entries
+    access_log = []
+    branches = tree.arrays(virtual=True, access_log=access_log)[5:17]
+    events = restructure(branches)
+    assert len(access_log) == 0
+    expected = restructure(tree.arrays(entry_start=5, entry_stop=17))
+    for field in expected.fields:
+        assert awkward.array_equal(
+            events[field], expected[field], equal_nan=True, check_parameters=False
+        ), field
+
+
+def test_columns():
+    # only the requested columns (and the branches they depend on) are built and read
+    columns = ["Muon.pt", "GenPart.distinctChildren", "GenPart.pdgId"]
+    projection = NanoAOD(columns=columns)
+    branches = projection.required_branches(tree.keys())
+    assert {"nGenPart", "GenPart_genPartIdxMother", "GenPart_pdgId"} <= branches
+    assert not any(branch.startswith(("Jet_", "Electron_")) for branch in branches)
+
+    access_log = []
+    events = projection(tree.arrays(virtual=True, access_log=access_log))
+    assert set(events.fields) == {"Muon", "GenPart", *NanoAOD.event_ids}
+    assert "distinctChildrenIdxG" in events.GenPart.fields
+    assert "genPartIdxG" not in events.Muon.fields
     assert awkward.array_equal(
-        zipper_array.Jet.muonIdxG, coffea_array.Jet.muonIdxG, check_parameters=False
+        events.GenPart.distinctChildren.pdgId,
+        coffea_array.GenPart.distinctChildren.pdgId,
+        check_parameters=False,
+    )
+    awkward.materialize(events)
+    assert {access.branch for access in access_log} <= branches
+
+
+def test_dry_run():
+    # the branches and derived fields an analysis needs are found from the Form alone
+    def analysis(events):
+        return events.GenPart.distinctChildren.pdgId, events.Muon.matched_gen().pt
+
+    access_log = []
+    branches, derived = restructure.dry_run(
+        analysis, tree.arrays(virtual=True, access_log=access_log)
     )
+    assert len(access_log) == 0
+    assert {
+        "nGenPart",
+        "GenPart_genPartIdxMother",
+        "GenPart_pdgId",
+        "nMuon",
+        "Muon_genPartIdx",
+    } <= branches
+    assert not any(branch.startswith(("Jet_", "Electron_")) for branch in branches)
+    assert {
+        "GenPart_distinctChildrenIdxG",
+        # the genealogy of GenPart is computed by one kernel, which the distinct children depend on
+        "_GenPart_genealogy",
+        "Muon_genPartIdxG",
+    } <= derived
+
+    # reading only these branches is enough to run the analysis
+    pruned = restructure(tree.arrays(filter_name=sorted(branches), virtual=True))
+    for pruned_result, result in zip(
+        analysis(pruned), analysis(zipper_array), strict=True
+    ):
+        assert awkward.array_equal(pruned_result, result, check_parameters=False)
+
+
+def test_nano_dy_kernels():
+    # test local2globalindex function
+    # local2globalindex function in awkward-zipper adds to the parameters, that it outputs a global index array
     assert awkward.array_equal(
-        zipper_array.Jet.electronIdxG,
-        coffea_array.Jet.electronIdxG,
+        zipper_array.Jet.electronIdx1G,
+        coffea_array.Jet.electronIdx1G,
         check_parameters=False,
     )
+    print(awkward.materialize(zipper_array.Jet.electronIdx1G))
+
+    # test nestedindex function
+    # nestedindex function in awkward-zipper adds to the parameters, that it outputs an array nested from two index arrays
+    # with one entry per index array, so the nested lists are regular
+    for collection, field in (
+        ("FatJet", "subJetIdxG"),
+        ("Jet", "muonIdxG"),
+        ("Jet", "electronIdxG"),
+    ):
+        nested = zipper_array[collection][field]
+        assert isinstance(nested.layout.content, awkward.contents.RegularArray)
+        assert awkward.array_equal(
+            awkward.from_regular(nested, axis=-1),
+            coffea_array[collection][field],
+            check_parameters=False,
+        )
     print(awkward.materialize(zipper_array.FatJet.subJetIdxG))
     print(awkward.materialize(zipper_array.Jet.muonIdxG))
     print(awkward.materialize(zipper_array.Jet.electronIdxG))
@@ -146,5 +482,18 @@ def test_behaviors():
 if __name__ == "__main__":
     test_access_log()
     test_nano_dy_whole()
+    test_from_form()
+    test_from_form_unsupported()
+    test_columns()
+    test_dry_run()
+    test_shared_offsets()
+    test_shared_genealogy()
+    test_known_lengths()
+    test_materialized_inputs()
+    test_index_dtype()
+    test_constant_columns()
+    test_shared_buffers()
+    test_table_aliases()
+    test_sliced_input()
     test_nano_dy_kernels()
     test_behaviors()